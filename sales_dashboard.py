@@ -1,14 +1,54 @@
+import time
+
+# 记录脚本开始执行的时间，用于启动耗时报告
+_SCRIPT_START = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import matplotlib.pyplot as plt
-import seaborn as sns
-from io import BytesIO
 import re
 import os
+import json
+import hashlib
+import glob
+import importlib
+import threading
+import tempfile
+from collections import OrderedDict
+
+from sales_parsing import (
+    COLUMNAR_CACHE_VERSION, parse_sales_workbook, parse_workbooks_parallel, source_fingerprint, file_sha256,
+    write_json_atomic, simplify_product_names, classify_packaging
+)
+
+# 基础库导入耗时预算（毫秒），超出时在启动耗时报告中提示
+IMPORT_TIME_BUDGET_MS = 1500
+
+# 启动阶段耗时记录：(阶段, 毫秒)
+startup_timings = [('导入基础库', (time.perf_counter() - _SCRIPT_START) * 1000)]
+
+
+def _record_startup_timing(label, start):
+    startup_timings.append((label, (time.perf_counter() - start) * 1000))
+
+
+# 延迟导入的模块：首次访问属性时才真正导入，并记录导入耗时
+class _LazyModule:
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._module_name)
+            _record_startup_timing(f"导入 {self._module_name}", start)
+        return getattr(self._module, attr)
+
+
+# plotly只在绘制图表时导入，保证首屏KPI卡片尽快显示
+px = _LazyModule('plotly.express')
+go = _LazyModule('plotly.graph_objects')
 
 # 设置页面配置
 st.set_page_config(
@@ -155,98 +195,396 @@ def format_yuan(value):
         return f"{value:.2f}元"
 
 
-# 加载数据函数 - 修复版本
-@st.cache_data
-def load_data(file_path=None):
-    """
-    从文件加载数据或使用示例数据，增强错误处理
-    """
-    # 如果提供了文件路径，从文件加载
-    if file_path and os.path.exists(file_path):
-        try:
-            df = pd.read_excel(file_path)
+# 增量存储目录（按发运月份分区保存各工作簿的预处理结果）
+INCREMENTAL_STORE_DIR = os.path.join(".cache", "incremental")
 
-            # 数据预处理
-            # 确保所有必要的列都存在
-            required_columns = ['客户简称', '所属区域', '发运月份', '申请人', '产品代码', '产品名称',
-                                '订单类型', '单价（箱）', '数量（箱）']
+# 上传文件缓存容量（所有会话共享，按最近最少使用淘汰）
+UPLOAD_CACHE_MAX_ENTRIES = 16
+UPLOAD_CACHE_MAX_BYTES = 1024 ** 3
 
-            missing_columns = [col for col in required_columns if col not in df.columns]
-            if missing_columns:
-                st.error(f"文件缺少必要的列: {', '.join(missing_columns)}。使用示例数据进行演示。")
-                return load_sample_data()
 
-            # 计算销售额
-            df['销售额'] = df['单价（箱）'] * df['数量（箱）']
+# 显示解析工作簿时记录的预处理警告
+def _report_parse_warnings(df, label=None):
+    for message in df.attrs.pop('parse_warnings', []):
+        st.warning(f"{label}: {message}" if label else message)
+
+
+# 解析多个工作簿并显示各文件的预处理警告
+def parse_workbooks(tasks):
+    results = parse_workbooks_parallel(tasks)
+    for label, df, _ in results:
+        if df is not None:
+            _report_parse_warnings(df, label)
+    return results
+
+
+# 加载单个本地工作簿（所有会话共享同一份数据）
+@st.cache_resource(max_entries=4)
+def _load_data_shared(source, compact=False):
+    """
+    source为(路径, 大小, 修改时间)元组，文件变化时缓存自动失效。
+    返回的对象由所有会话共享，不能原地修改，只通过load_data交出浅拷贝
+    """
+    try:
+        df = parse_sales_workbook(source[0])
+        _report_parse_warnings(df)
+        return finalize_sales_frame(df, compact)
+    except Exception as e:
+        st.error(f"文件加载失败: {str(e)}。使用示例数据进行演示。")
+        return load_sample_data(compact)
 
-            # 确保发运月份是日期类型
-            try:
-                df['发运月份'] = pd.to_datetime(df['发运月份'])
-            except Exception as e:
-                st.warning(f"转换日期格式时出错: {str(e)}。月份分析功能可能受影响。")
-
-            # 确保所有的字符串列都是字符串类型
-            for col in ['客户简称', '所属区域', '申请人', '产品代码', '产品名称', '订单类型']:
-                df[col] = df[col].astype(str)
-
-            # 添加简化产品名称列
-            df['简化产品名称'] = df.apply(
-                lambda row: get_simplified_product_name(row['产品代码'], row['产品名称']),
-                axis=1
-            )
 
-            return df
-        except Exception as e:
-            st.error(f"文件加载失败: {str(e)}。使用示例数据进行演示。")
-            return load_sample_data()
+# 加载数据函数 - 修复版本
+def load_data(file_path=None, compact=False):
+    """
+    从文件加载数据或使用示例数据，增强错误处理。
+    Excel文件只解析一次，预处理结果保存为列式缓存，源文件未变化时直接读取缓存。
+    解析后的数据按文件指纹放在共享缓存中，每次重新运行只返回浅拷贝，不再反序列化整表副本。
+    compact为True时返回维度列为分类类型的紧凑数据
+    """
+    # 如果提供了文件路径，从文件加载（上传的文件对象由load_uploaded_files处理）
+    if isinstance(file_path, (str, os.PathLike)) and os.path.exists(file_path):
+        stat = os.stat(file_path)
+        source = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        return _load_data_shared(source, compact).copy(deep=False)
     else:
         # 没有文件路径或文件不存在，使用示例数据
         if file_path:
             st.warning(f"文件路径不存在: {file_path}。使用示例数据进行演示。")
-        return load_sample_data()
+        return load_sample_data(compact)
+
+
+# 展开工作簿目录或通配符
+def expand_workbook_sources(pattern):
+    """
+    将目录或通配符展开为排序后的Excel文件列表（目录下匹配所有xlsx/xls文件）
+    """
+    pattern = os.path.expanduser(pattern.strip())
+    if os.path.isdir(pattern):
+        paths = glob.glob(os.path.join(pattern, '*.xlsx')) + glob.glob(os.path.join(pattern, '*.xls'))
+    else:
+        paths = glob.glob(pattern, recursive=True)
+
+    return sorted(
+        path for path in paths
+        if os.path.isfile(path) and path.lower().endswith(('.xlsx', '.xls'))
+        and not os.path.basename(path).startswith('~$')  # 跳过Excel临时文件
+    )
 
 
-# 创建产品代码到简化产品名称的映射函数 - 修复版本
-def get_simplified_product_name(product_code, product_name):
+# 合并多个工作簿的解析结果
+def combine_workbook_results(results, compact=False):
     """
-    从产品名称中提取简化产品名称，增强错误处理
+    合并解析成功的工作簿并添加来源文件列，报告未通过校验的文件
     """
+    frames = [df for _, df, error in results if error is None]
+    failures = [f"{label}（{error}）" for label, _, error in results if error is not None]
+
+    if failures:
+        st.warning(f"以下文件未能加载，已跳过: {'; '.join(failures)}")
+
+    if not frames:
+        st.error("没有可用的工作簿数据。使用示例数据进行演示。")
+        return load_sample_data(compact)
+
+    combined_df = pd.concat(frames, ignore_index=True)
+    return finalize_sales_frame(combined_df, compact)
+
+
+# 加载多个本地工作簿（所有会话共享同一份数据）
+@st.cache_resource(max_entries=4)
+def _load_workbook_files_shared(sources, compact=False):
+    tasks = [(os.path.basename(path), path) for path, _, _ in sources]
+    return combine_workbook_results(parse_workbooks(tasks), compact)
+
+
+# 加载多个本地工作簿
+def load_workbook_files(sources, compact=False):
+    """
+    并行加载多个本地工作簿并合并。sources为(路径, 大小, 修改时间)元组，文件变化时缓存自动失效。
+    合并结果由所有会话共享，返回浅拷贝
+    """
+    return _load_workbook_files_shared(sources, compact).copy(deep=False)
+
+
+# 发运月份分区键
+def _month_partition_keys(months):
+    if pd.api.types.is_datetime64_any_dtype(months):
+        return months.dt.strftime('%Y-%m').fillna('unknown')
+    # 日期转换失败时按原始取值的前7个字符分区
+    return months.astype(str).str[:7].str.replace(os.sep, '-', regex=False)
+
+
+# 同步增量存储
+def sync_incremental_store(paths):
+    """
+    按发运月份分区维护各工作簿的预处理结果。只有新增或内容变化的工作簿会被重新解析并写入分区，
+    未变化工作簿的分区原样复用。返回(合并后的数据, 重新解析的文件, 复用的文件, 失败信息)
+    """
+    manifest_path = os.path.join(INCREMENTAL_STORE_DIR, 'manifest.json')
+    manifest = {'version': COLUMNAR_CACHE_VERSION, 'sources': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        if stored.get('version') == COLUMNAR_CACHE_VERSION:
+            manifest = stored
+
+    # 找出新增或变化的工作簿
+    fingerprints = {}
+    changed_paths = []
+    for path in paths:
+        fingerprint = source_fingerprint(path)
+        fingerprints[fingerprint['path']] = fingerprint
+        entry = manifest['sources'].get(fingerprint['path'])
+        if entry is None or entry['size'] != fingerprint['size']:
+            changed_paths.append(fingerprint['path'])
+        elif entry['mtime_ns'] != fingerprint['mtime_ns']:
+            # 修改时间变化但内容可能未变
+            fingerprint['sha256'] = file_sha256(fingerprint['path'])
+            if fingerprint['sha256'] == entry['sha256']:
+                entry['mtime_ns'] = fingerprint['mtime_ns']
+            else:
+                changed_paths.append(fingerprint['path'])
+
+    # 只解析变化的工作簿，并重写它们的分区
+    failures = []
+    tasks = [(os.path.basename(path), path) for path in changed_paths]
+    for path, (label, df, error) in zip(changed_paths, parse_workbooks(tasks)):
+        old_entry = manifest['sources'].pop(path, None)
+        for partition_file in (old_entry or {}).get('partitions', []):
+            partition_path = os.path.join(INCREMENTAL_STORE_DIR, partition_file)
+            if os.path.exists(partition_path):
+                os.remove(partition_path)
+
+        if error is not None:
+            failures.append(f"{label}（{error}）")
+            continue
+
+        source_key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        partitions = []
+        for month_key, part in df.groupby(_month_partition_keys(df['发运月份']), sort=True):
+            partition_file = os.path.join(f"month={month_key}", f"{source_key}.parquet")
+            partition_path = os.path.join(INCREMENTAL_STORE_DIR, partition_file)
+            os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+            part.to_parquet(partition_path, index=False)
+            partitions.append(partition_file)
+
+        fingerprint = fingerprints[path]
+        manifest['sources'][path] = {
+            'size': fingerprint['size'],
+            'mtime_ns': fingerprint['mtime_ns'],
+            'sha256': fingerprint.get('sha256') or file_sha256(path),
+            'partitions': partitions
+        }
+
+    os.makedirs(INCREMENTAL_STORE_DIR, exist_ok=True)
+    write_json_atomic(manifest_path, manifest)
+
+    # 读取当前所选工作簿的全部分区
+    frames = [
+        pd.read_parquet(os.path.join(INCREMENTAL_STORE_DIR, partition_file))
+        for path in fingerprints if path in manifest['sources']
+        for partition_file in manifest['sources'][path]['partitions']
+    ]
+    combined_df = pd.concat(frames, ignore_index=True) if frames else None
+
+    reused = [os.path.basename(path) for path in fingerprints if path not in changed_paths]
+    parsed = [os.path.basename(path) for path in changed_paths if path in manifest['sources']]
+    return combined_df, parsed, reused, failures
+
+
+# 增量加载多个本地工作簿（所有会话共享同一份数据）
+@st.cache_resource(max_entries=4)
+def _load_incremental_workbooks_shared(sources, compact=False):
     try:
-        # 确保输入是字符串类型
-        if not isinstance(product_name, str):
-            return str(product_code)  # 返回产品代码作为备选
-
-        if '口力' in product_name:
-            # 提取"口力"之后的产品类型
-            name_parts = product_name.split('口力')
-            if len(name_parts) > 1:
-                name_part = name_parts[1]
-                if '-' in name_part:
-                    name_part = name_part.split('-')[0].strip()
-
-                # 进一步简化，只保留主要部分（去掉规格和包装形式）
-                for suffix in ['G分享装袋装', 'G盒装', 'G袋装', 'KG迷你包', 'KG随手包']:
-                    if suffix in name_part:
-                        name_part = name_part.split(suffix)[0]
-                        break
-
-                # 去掉可能的数字和单位
-                simple_name = re.sub(r'\d+\w*\s*', '', name_part).strip()
-
-                if simple_name:  # 确保简化名称不为空
-                    return f"{simple_name} ({product_code})"
-
-        # 如果无法提取或处理中出现错误，则返回产品代码
-        return str(product_code)
+        combined_df, parsed, reused, failures = sync_incremental_store([path for path, _, _ in sources])
     except Exception as e:
-        # 捕获任何异常，确保函数始终返回一个字符串
-        print(f"简化产品名称时出错: {e}，产品代码: {product_code}")
-        return str(product_code)
+        st.warning(f"增量存储不可用: {str(e)}。改为完整解析全部工作簿。")
+        return _load_workbook_files_shared(sources, compact)
+
+    if failures:
+        st.warning(f"以下文件未能加载，已跳过: {'; '.join(failures)}")
+
+    if combined_df is None:
+        st.error("没有可用的工作簿数据。使用示例数据进行演示。")
+        return load_sample_data(compact)
+
+    combined_df.attrs['incremental_stats'] = {'parsed': len(parsed), 'reused': len(reused)}
+    return finalize_sales_frame(combined_df, compact)
+
+
+# 增量加载多个本地工作簿
+def load_incremental_workbooks(sources, compact=False):
+    """
+    通过增量存储加载多个本地工作簿，新一批数据到达时只解析新增或变化的工作簿。
+    sources为(路径, 大小, 修改时间)元组；合并结果由所有会话共享，返回浅拷贝
+    """
+    return _load_incremental_workbooks_shared(sources, compact).copy(deep=False)
+
+
+# 上传文件解析结果缓存（所有会话共享）
+@st.cache_resource
+def get_upload_cache():
+    return {'entries': OrderedDict(), 'total_bytes': 0, 'lock': threading.Lock()}
+
+
+def _upload_cache_get(key):
+    cache = get_upload_cache()
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is None:
+            return None
+        cache['entries'].move_to_end(key)
+        return entry['data']
+
+
+def _upload_cache_put(key, df):
+    """
+    写入上传文件缓存，超出条目数或内存上限时按最近最少使用淘汰
+    """
+    size = int(df.memory_usage(deep=True).sum())
+    cache = get_upload_cache()
+    with cache['lock']:
+        if key in cache['entries']:
+            return
+        cache['entries'][key] = {'data': df, 'bytes': size}
+        cache['total_bytes'] += size
+        while len(cache['entries']) > 1 and (len(cache['entries']) > UPLOAD_CACHE_MAX_ENTRIES
+                                             or cache['total_bytes'] > UPLOAD_CACHE_MAX_BYTES):
+            _, evicted = cache['entries'].popitem(last=False)
+            cache['total_bytes'] -= evicted['bytes']
+
+
+# 计算上传文件的内容摘要（每个上传文件只计算一次）
+def _upload_digest(uploaded_file):
+    digests = st.session_state.setdefault('upload_digests', {})
+    key = (getattr(uploaded_file, 'file_id', None) or uploaded_file.name, uploaded_file.size)
+    if key not in digests:
+        digests[key] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return digests[key]
+
+
+# 加载上传的工作簿
+def load_uploaded_files(uploaded_files, compact=False):
+    """
+    按内容的SHA-256摘要缓存上传文件的解析结果，缓存由所有会话共享。
+    同一工作簿再次上传（包括其他用户上传）时直接复用，无需重新解析；多个文件并行解析后合并。
+    缓存中的对象不直接交给调用方：返回浅拷贝，调用方增删列或修改attrs不会影响其他会话
+    """
+    digests = tuple(_upload_digest(file) for file in uploaded_files)
+    names = tuple(file.name for file in uploaded_files) if len(uploaded_files) > 1 else None
+    dataset_key = ('dataset', digests, names, compact)
+
+    cached_df = _upload_cache_get(dataset_key)
+    if cached_df is not None:
+        return cached_df.copy(deep=False)
+
+    # 逐个文件查找解析结果，未命中的文件并行解析
+    frames = {digest: _upload_cache_get(('file', digest)) for digest in digests}
+    tasks = [(file.name, file.getvalue()) for file, digest in zip(uploaded_files, digests)
+             if frames[digest] is None]
+    missing_digests = [digest for file, digest in zip(uploaded_files, digests) if frames[digest] is None]
+
+    failures = []
+    for digest, (label, parsed_df, error) in zip(missing_digests, parse_workbooks(tasks)):
+        if error is not None:
+            failures.append(f"{label}（{error}）")
+            continue
+        parsed_df = parsed_df.drop(columns='来源文件')
+        frames[digest] = parsed_df
+        # 单个文件时整个数据集只以数据集键缓存一次，避免同一份数据占用两个条目
+        if len(uploaded_files) > 1:
+            _upload_cache_put(('file', digest), parsed_df)
+
+    if failures:
+        st.warning(f"以下文件未能加载，已跳过: {'; '.join(failures)}")
+
+    available = [(file.name, frames[digest]) for file, digest in zip(uploaded_files, digests)
+                 if frames[digest] is not None]
+    if not available:
+        st.error("没有可用的工作簿数据。使用示例数据进行演示。")
+        return load_sample_data(compact)
+
+    if len(uploaded_files) == 1:
+        # 文件可能来自缓存中的单文件条目，在副本上处理
+        combined_df = available[0][1].copy(deep=False)
+    else:
+        combined_df = pd.concat([frame.assign(来源文件=name) for name, frame in available], ignore_index=True)
+    combined_df = finalize_sales_frame(combined_df, compact)
+
+    # 只缓存全部文件都解析成功的结果
+    if not failures:
+        _upload_cache_put(dataset_key, combined_df)
+    return combined_df.copy(deep=False)
+
+
+# 维度列（紧凑模式下转换为分类类型）
+DIMENSION_COLUMNS = ['客户简称', '所属区域', '申请人', '产品代码', '产品名称', '订单类型', '简化产品名称', '来源文件']
+
+
+# 数值列无损向下转换
+def _downcast_numeric(series):
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series):
+        downcast = series.astype(np.float32)
+        # 只有转换后数值完全不变时才使用float32
+        if np.array_equal(downcast.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64), equal_nan=True):
+            return downcast
+    return series
+
+
+# 转换为紧凑的数据表示
+def compact_sales_frame(df):
+    """
+    将维度列转换为分类类型（类别列表按取值排序，筛选后的子集共享同一类别列表），
+    数值列在不损失精度时向下转换。转换前后的内存占用记录在attrs中
+    """
+    memory_before = int(df.memory_usage(deep=True).sum())
+
+    compact_df = df.copy()
+    for col in DIMENSION_COLUMNS:
+        if col in compact_df.columns:
+            values = compact_df[col]
+            categories = sorted(values.dropna().astype(str).unique())
+            compact_df[col] = pd.Categorical(values, categories=categories)
+
+    for col in compact_df.select_dtypes(include='number').columns:
+        compact_df[col] = _downcast_numeric(compact_df[col])
+
+    compact_df.attrs['memory_before'] = memory_before
+    compact_df.attrs['memory_after'] = int(compact_df.memory_usage(deep=True).sum())
+    return compact_df
+
+
+# 完成数据加载
+def finalize_sales_frame(df, compact=False):
+    """
+    按需转换为紧凑表示，并根据数据内容计算数据集版本，记录在attrs中。
+    版本在加载时计算一次，作为筛选索引等派生结构的缓存键
+    """
+    if compact:
+        df = compact_sales_frame(df)
+
+    content_hash = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    content_hash.update(','.join(map(str, df.columns)).encode('utf-8'))
+    df.attrs['dataset_version'] = f"{content_hash.hexdigest()}-{'compact' if compact else 'full'}"
+    return df
+
+
+# 解析产品规格重量
+def parse_product_weight(product_names):
+    """从产品名称中解析规格重量（克），支持"60G"和"1.5KG"两种写法，无法识别时为NaN"""
+    names = pd.Series(product_names, dtype=object)
+    text = names.where(names.map(lambda x: isinstance(x, str)), '')
+    kilograms = text.str.extract(r'(\d+(?:\.\d+)?)KG', flags=re.IGNORECASE, expand=False).astype(float)
+    grams = text.str.extract(r'(\d+)G', expand=False).astype(float)
+    return (kilograms * 1000).fillna(grams).to_numpy(dtype=float)
 
 
 # 创建示例数据（以防用户没有上传文件） - 修复版本
 @st.cache_data
-def load_sample_data():
+def load_sample_data(compact=False):
     """
     创建示例数据，确保所有列表长度一致
     """
@@ -308,13 +646,11 @@ def load_sample_data():
             mask = df['所属区域'] == region
             df.loc[mask, '销售额'] = df.loc[mask, '销售额'] * factor
 
-        # 添加简化产品名称
-        df['简化产品名称'] = df.apply(
-            lambda row: get_simplified_product_name(row['产品代码'], row['产品名称']),
-            axis=1
-        )
+        # 添加简化产品名称和包装类型
+        df['简化产品名称'] = simplify_product_names(df)
+        df['包装类型'] = classify_packaging(df['产品名称'])
 
-        return df
+        return finalize_sales_frame(df, compact)
     except Exception as e:
         # 如果示例数据创建失败，创建一个最小化的DataFrame
         st.error(f"创建示例数据时出错: {str(e)}。使用简化版示例数据。")
@@ -333,8 +669,1048 @@ def load_sample_data():
             '销售额': [1000, 2250, 4000],
             '简化产品名称': ['产品A (X001)', '产品B (X002)', '产品C (X003)']
         })
+        simple_df['包装类型'] = classify_packaging(simple_df['产品名称'])
+
+        return finalize_sales_frame(simple_df, compact)
+
+
+# 侧边栏筛选器对应的维度列
+FILTER_DIMENSIONS = ['所属区域', '客户简称', '产品代码', '申请人']
+
+
+# 构建筛选索引
+@st.cache_resource(max_entries=8)
+def build_filter_index(version, _df):
+    """
+    为每个筛选维度预先计算每行的取值编码，以及按取值分组的行号数组（offsets标记每个取值的起止位置）。
+    按数据集版本缓存，筛选时只需对行号数组做并集和交集
+    """
+    dimensions = {}
+    for col in FILTER_DIMENSIONS:
+        codes, uniques = pd.factorize(_df[col])
+        row_order = np.argsort(codes, kind='stable')
+        offsets = np.searchsorted(codes[row_order], np.arange(len(uniques) + 1))
+        dimensions[col] = {
+            'codes': codes,
+            'lookup': {str(value): code for code, value in enumerate(uniques)},
+            'rows': row_order,
+            'offsets': offsets,
+            'has_missing': bool((codes < 0).any())
+        }
+    return {'n_rows': len(_df), 'dimensions': dimensions}
+
+
+# 根据筛选条件计算行号
+def filter_row_ids(filter_index, selections):
+    """
+    selections为{维度列: 选中的取值列表}，空列表表示该维度不筛选；选中全部取值（且没有缺失值）的维度也会跳过。
+    从命中行数最少的维度开始，用其余维度的编码逐步过滤，耗时取决于选择性而不是数据表大小。
+    返回升序排列的行号数组，没有生效的筛选条件时返回None
+    """
+    active = []
+    for col, values in selections.items():
+        if not values:
+            continue
+        dimension = filter_index['dimensions'][col]
+        codes = np.array(sorted({dimension['lookup'][value] for value in values if value in dimension['lookup']}),
+                         dtype=np.int64)
+        if len(codes) == len(dimension['lookup']) and not dimension['has_missing']:
+            continue
+        offsets = dimension['offsets']
+        size = int((offsets[codes + 1] - offsets[codes]).sum()) if len(codes) else 0
+        active.append((size, col, codes))
+
+    if not active:
+        return None
+
+    active.sort(key=lambda item: item[0])
+    _, col, codes = active[0]
+    dimension = filter_index['dimensions'][col]
+    offsets = dimension['offsets']
+    if len(codes) == 0:
+        return np.empty(0, dtype=np.int64)
+    row_ids = np.concatenate([dimension['rows'][offsets[code]:offsets[code + 1]] for code in codes])
+
+    for _, col, codes in active[1:]:
+        dimension = filter_index['dimensions'][col]
+        selected = np.zeros(len(dimension['lookup']) + 1, dtype=bool)
+        selected[codes] = True
+        # 缺失值的编码为-1，对应selected的最后一位（始终为False）
+        row_ids = row_ids[selected[dimension['codes'][row_ids]]]
+
+    return np.sort(row_ids)
+
+
+# 按行号取出筛选结果
+def take_filtered_rows(df, row_ids):
+    if row_ids is None:
+        return df
+    return df.take(row_ids)
+
+
+# 新品目录文件：每行一个产品代码，可选上市日期和新品期（月）。
+# 上市日期为空时该产品在所有月份都视为新品，新品期为空时上市后一直视为新品
+NEW_PRODUCT_CATALOGUE_PATH = "new_products.csv"
+NEW_PRODUCT_CATALOGUE_COLUMNS = ['产品代码', '上市日期', '新品期（月）']
+
+
+# 读取新品目录
+@st.cache_data
+def read_new_product_catalogue(path, modified_time):
+    """按文件修改时间缓存，目录文件更新后自动重新读取"""
+    catalogue = pd.read_csv(path, dtype={'产品代码': str})
+    missing = [col for col in NEW_PRODUCT_CATALOGUE_COLUMNS[:1] if col not in catalogue.columns]
+    if missing:
+        raise ValueError(f"新品目录缺少列: {', '.join(missing)}")
+    catalogue = catalogue.reindex(columns=NEW_PRODUCT_CATALOGUE_COLUMNS)
+    catalogue['产品代码'] = catalogue['产品代码'].astype(str).str.strip()
+    catalogue['上市日期'] = pd.to_datetime(catalogue['上市日期'], errors='coerce')
+    catalogue['新品期（月）'] = pd.to_numeric(catalogue['新品期（月）'], errors='coerce')
+    return catalogue.drop_duplicates('产品代码', keep='last').reset_index(drop=True)
+
+
+# 加载新品目录
+def load_new_product_catalogue(path=NEW_PRODUCT_CATALOGUE_PATH):
+    """目录文件不存在或无法读取时提示，并返回空目录（不标记任何新品）"""
+    empty = pd.DataFrame({
+        '产品代码': pd.Series(dtype=object),
+        '上市日期': pd.Series(dtype='datetime64[ns]'),
+        '新品期（月）': pd.Series(dtype=float)
+    })
+    if not os.path.exists(path):
+        st.sidebar.warning(f"没有找到新品目录文件: {path}，所有产品都不标记为新品。")
+        return empty
+    try:
+        return read_new_product_catalogue(path, os.stat(path).st_mtime_ns)
+    except Exception as e:
+        st.sidebar.error(f"读取新品目录时出错: {str(e)}，所有产品都不标记为新品。")
+        return empty
+
+
+# 新品目录版本
+def new_product_catalogue_version(catalogue):
+    """目录内容的哈希，与数据集版本组合后作为新品标记及其派生结构的缓存键"""
+    content = pd.util.hash_pandas_object(catalogue, index=False).to_numpy().tobytes()
+    return hashlib.sha1(content).hexdigest()[:12]
+
+
+# 计算行级新品标记
+def flag_new_products(df, catalogue):
+    """
+    产品代码在新品目录中、且发运月份落在 [上市月份, 上市月份+新品期) 内的行标记为1，其余为0（int8）。
+    按月比较，同一产品同一月份的标记一致，因此标记可以作为汇总立方体和月度汇总的维度；
+    发运月份缺失的行只在该产品没有上市日期和新品期时标记为新品
+    """
+    product_codes, products = pd.factorize(df['产品代码'])
+    catalogue = catalogue.set_index('产品代码')
+    keys = pd.Index(products).astype(str)
+    in_catalogue = np.append(keys.isin(catalogue.index), False)
+
+    launch = pd.to_datetime(catalogue['上市日期'].reindex(keys))
+    window = catalogue['新品期（月）'].reindex(keys).to_numpy(dtype=float)
+    first_month = (launch.dt.year * 12 + launch.dt.month - 1).to_numpy(dtype=float)
+    start = np.append(np.where(np.isnan(first_month), -np.inf, first_month), np.inf)
+    end = np.append(np.where(np.isnan(first_month) | np.isnan(window), np.inf, first_month + window), np.inf)
+    always = np.isinf(start) & np.isinf(end)
+
+    months = pd.to_datetime(df['发运月份'], errors='coerce')
+    month_index = (months.dt.year * 12 + months.dt.month - 1).to_numpy(dtype=float)
+    # 缺失的产品代码编码为-1，对应各数组的最后一位（不在目录中）
+    in_window = (month_index >= start[product_codes]) & (month_index < end[product_codes])
+    flags = in_catalogue[product_codes] & np.where(np.isnan(month_index), always[product_codes], in_window)
+    return flags.astype(np.int8)
+
+
+# 构建行级新品标记
+@st.cache_resource(max_entries=8)
+def build_new_product_flags(version, _df, _catalogue):
+    """按 数据集版本:目录版本 缓存，加载后计算一次，各模块的新品拆分都直接复用该标记"""
+    return flag_new_products(_df, _catalogue)
+
+
+# 在筛选结果中取出新品行
+def flagged_row_ids(row_ids, flags):
+    """row_ids 为None（未筛选）时在全部行中查找，返回新品标记为1的行号"""
+    if row_ids is None:
+        return np.flatnonzero(flags)
+    return row_ids[flags[row_ids] == 1]
+
+
+# 构建产品维度表
+@st.cache_resource(max_entries=8)
+def build_product_dimension(version, _df, _new_product_flags=None):
+    """
+    一次drop_duplicates得到以产品代码为索引的产品维度表：简化产品名称、包装类型、规格重量（克）、是否新品
+    （_new_product_flags 中有任意一行标记为新品的产品）。同一产品代码取首次出现的记录，侧边栏、各图表和导出报告都从这张表取产品属性
+    """
+    columns = [col for col in ['产品代码', '产品名称', '简化产品名称', '包装类型'] if col in _df.columns]
+    products = _df[columns].drop_duplicates('产品代码')
+    products = products.assign(产品代码=products['产品代码'].astype(str)).set_index('产品代码')
+
+    if '简化产品名称' not in products.columns:
+        products['简化产品名称'] = products.index
+    products['简化产品名称'] = products['简化产品名称'].astype(str)
+    products['规格重量'] = parse_product_weight(products['产品名称']) if '产品名称' in products.columns else np.nan
+    if _new_product_flags is not None:
+        flagged = _df['产品代码'][_new_product_flags == 1]
+        products['是否新品'] = products.index.isin(pd.unique(flagged.astype(str)))
+    else:
+        products['是否新品'] = False
+    return products.drop(columns=['产品名称'], errors='ignore')
+
+
+# 汇总立方体的维度（发运月份截断到月）
+CUBE_DIMENSIONS = ['所属区域', '客户简称', '申请人', '产品代码', '简化产品名称', '包装类型', '发运月份', '订单类型',
+                   '是否新品']
+
+
+# 构建销售汇总立方体
+@st.cache_resource(max_entries=8)
+def build_sales_cube(version, _df, _new_product_flags=None):
+    """
+    按 区域×客户×申请人×产品×月份×订单类型 的粒度预先汇总销售额、数量、单价合计/计数和行数
+    （简化产品名称和包装类型是产品属性，新品标记由产品和月份决定，一并保留）。按数据集版本缓存，各图表的分组查询都在筛选后的立方体上完成
+    """
+    months = _df['发运月份']
+    if pd.api.types.is_datetime64_any_dtype(months):
+        months = months.dt.to_period('M').dt.to_timestamp()
+
+    # 新品标记以数组传入，只加在分组用的临时副本上，不修改原数据表
+    columns = {'发运月份': months}
+    if _new_product_flags is not None:
+        columns['是否新品'] = _new_product_flags
+    source = _df.assign(**columns)
+    dimensions = [col for col in CUBE_DIMENSIONS if col in source.columns]
+    cube = source.groupby(dimensions, observed=True, dropna=False, sort=False).agg(
+        销售额=('销售额', 'sum'),
+        数量=('数量（箱）', 'sum'),
+        单价合计=('单价（箱）', 'sum'),
+        单价计数=('单价（箱）', 'count'),
+        行数=('销售额', 'size')
+    ).reset_index().rename(columns={'数量': '数量（箱）'})
+    return cube
+
+
+# 规范化筛选状态
+def normalize_filter_state(selections):
+    """把筛选条件转换为与选择顺序无关、可哈希的元组（未选择的维度不参与）"""
+    return tuple(
+        (dimension, tuple(sorted(str(value) for value in values)))
+        for dimension, values in sorted(selections.items()) if values
+    )
+
+
+# 结果缓存的容量：最多保留的筛选组合数和估算内存上限
+RESULT_CACHE_MAX_ENTRIES = 32
+RESULT_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+
+# 筛选结果缓存（所有会话共享）
+@st.cache_resource
+def get_result_cache():
+    """
+    按 (数据集版本, 筛选状态) 保存各模块的计算结果，每个筛选组合一个条目；
+    超出条目数或估算内存上限时按最近最少使用整体淘汰，并统计命中/未命中次数
+    """
+    return {'entries': OrderedDict(), 'total_bytes': 0, 'hits': 0, 'misses': 0, 'lock': threading.Lock()}
+
+
+# 估算缓存结果占用的内存
+def _estimate_result_bytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(_estimate_result_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_result_bytes(item) for item in value)
+    if all(hasattr(value, attr) for attr in ('data', 'indices', 'indptr')):
+        # scipy稀疏矩阵
+        return int(value.data.nbytes + value.indices.nbytes + value.indptr.nbytes)
+    return 64
+
+
+# 获取聚合登记表
+def get_aggregate_registry(dataset_version, filter_state, sources):
+    """
+    聚合登记表指向结果缓存中当前 (数据集版本, 筛选状态) 的条目，各模块和导出报告共用其中的结果，
+    切换回之前用过的筛选组合时直接复用。sources 为 {来源名: 筛选后的立方体}
+    """
+    scope = (dataset_version, filter_state)
+    cache = get_result_cache()
+    with cache['lock']:
+        entry = cache['entries'].get(scope)
+        if entry is None:
+            entry = cache['entries'][scope] = {'results': {}, 'bytes': 0}
+        cache['entries'].move_to_end(scope)
+    return {'scope': scope, 'sources': sources, 'entry': entry, 'cache': cache}
+
+
+# 从结果缓存获取计算结果
+def get_cached_result(registry, spec, compute):
+    """
+    spec 为结果在当前筛选组合内的键；未命中时调用compute计算并写入缓存，
+    超出条目数或内存上限时淘汰最久未使用的其他筛选组合
+    """
+    cache = registry['cache']
+    entry = registry['entry']
+    with cache['lock']:
+        if spec in entry['results']:
+            cache['hits'] += 1
+            return entry['results'][spec]
+
+    result = compute()
+    size = _estimate_result_bytes(result)
+    with cache['lock']:
+        cache['misses'] += 1
+        if spec not in entry['results']:
+            entry['results'][spec] = result
+            entry['bytes'] += size
+            if cache['entries'].get(registry['scope']) is entry:
+                cache['total_bytes'] += size
+        while len(cache['entries']) > 1 and (len(cache['entries']) > RESULT_CACHE_MAX_ENTRIES
+                                             or cache['total_bytes'] > RESULT_CACHE_MAX_BYTES):
+            _, evicted = cache['entries'].popitem(last=False)
+            cache['total_bytes'] -= evicted['bytes']
+        return entry['results'][spec]
+
+
+# 按聚合规格获取结果
+def get_aggregate(registry, source, by=None, column='销售额', func='sum'):
+    """
+    by 为空时返回整体标量，否则返回按 by 分组的 Series。已计算过的规格直接复用，
+    返回的 Series 是副本，调用方可以随意修改
+    """
+    by = (by,) if isinstance(by, str) else tuple(by or ())
+
+    def compute():
+        frame = registry['sources'][source]
+        if by:
+            return frame.groupby(list(by), observed=True)[column].agg(func)
+        return frame[column].agg(func)
+
+    result = get_cached_result(registry, ('aggregate', source, by, column, func), compute)
+    return result.copy() if isinstance(result, pd.Series) else result
+
+
+# 按多个聚合规格组装汇总表
+def get_aggregate_table(registry, source, by, specs):
+    """specs 为 [(输出列, 数据列, 聚合函数), ...]，每一列都通过聚合登记表获取"""
+    return pd.concat(
+        {name: get_aggregate(registry, source, by, column, func) for name, column, func in specs}, axis=1
+    ).reset_index()
+
+
+# 共现矩阵：客户×产品关联矩阵的非零占比低于该阈值时使用稀疏矩阵
+CO_OCCURRENCE_DENSITY_THRESHOLD = 0.05
+# 每个新品展示的共同购买产品数量
+CO_OCCURRENCE_TOP_K = 5
+# 共现矩阵明细表最多展示的产品数（按销售额取前N个）
+CO_OCCURRENCE_TABLE_MAX_PRODUCTS = 50
+
+
+# 导入稀疏矩阵库（可选依赖）
+def _load_scipy_sparse():
+    """未安装scipy时返回None，共现矩阵改用稠密NumPy计算"""
+    try:
+        return importlib.import_module('scipy.sparse')
+    except ImportError:
+        return None
+
+
+# 构建产品共现矩阵
+def build_co_occurrence(customer_product_sales):
+    """
+    由 客户×产品 的销售额汇总构建二值关联矩阵 B，共现矩阵 = BᵀB（对角线为购买该产品的客户数）。
+    关联矩阵非零占比低于阈值且已安装scipy时使用稀疏矩阵，否则使用稠密float32矩阵乘法
+    """
+    purchased = customer_product_sales[customer_product_sales > 0]
+    customer_codes, customers = pd.factorize(purchased.index.get_level_values('客户简称'))
+    product_codes, products = pd.factorize(purchased.index.get_level_values('产品代码').astype(str))
+    shape = (len(customers), len(products))
+    density = len(purchased) / (shape[0] * shape[1]) if shape[0] and shape[1] else 0.0
+
+    sparse = _load_scipy_sparse() if density < CO_OCCURRENCE_DENSITY_THRESHOLD else None
+    if sparse is not None:
+        incidence = sparse.csr_matrix(
+            (np.ones(len(purchased), dtype=np.float32), (customer_codes, product_codes)), shape=shape
+        )
+        matrix = (incidence.T @ incidence).tocsr()
+        product_customers = matrix.diagonal()
+        matrix.setdiag(0)
+        matrix.eliminate_zeros()
+    else:
+        incidence = np.zeros(shape, dtype=np.float32)
+        incidence[customer_codes, product_codes] = 1
+        matrix = incidence.T @ incidence
+        product_customers = matrix.diagonal().copy()
+        np.fill_diagonal(matrix, 0)
+
+    return {
+        'customers': customers,
+        'products': pd.Index(products),
+        'incidence': incidence,
+        'matrix': matrix,
+        'is_sparse': sparse is not None,
+        'density': density,
+        'products_per_customer': np.bincount(customer_codes, minlength=shape[0]),
+        'product_customers': product_customers.astype(np.int64)
+    }
+
+
+# 获取某个产品共同购买最多的产品
+def co_occurrence_top_k(co_occurrence, product, k=CO_OCCURRENCE_TOP_K):
+    """只读取该产品所在的一行，返回共现次数最高的k个产品（不含共现次数为0的产品）"""
+    position = co_occurrence['products'].get_loc(product)
+    row = co_occurrence['matrix'][position]
+    if co_occurrence['is_sparse']:
+        columns, counts = row.indices, row.data
+    else:
+        columns = np.flatnonzero(row)
+        counts = row[columns]
+
+    if len(counts) > k:
+        keep = np.argpartition(-counts, k - 1)[:k]
+        columns, counts = columns[keep], counts[keep]
+    order = np.argsort(-counts, kind='stable')
+    return pd.Series(counts[order].astype(np.int64), index=co_occurrence['products'][columns[order]], name='共现次数')
+
+
+# 获取指定产品之间的共现子矩阵
+def co_occurrence_submatrix(co_occurrence, products):
+    """只取出指定产品对应的行列，返回以产品代码为行列索引的稠密DataFrame"""
+    positions = co_occurrence['products'].get_indexer(products)
+    sub = co_occurrence['matrix'][positions][:, positions]
+    if co_occurrence['is_sparse']:
+        sub = sub.toarray()
+    return pd.DataFrame(sub.astype(np.int64), index=list(products), columns=list(products))
+
+
+# 统计购买过指定产品中任意一个的客户数
+def count_customers_with_products(co_occurrence, products):
+    positions = co_occurrence['products'].get_indexer([p for p in products if p in co_occurrence['products']])
+    if len(positions) == 0:
+        return 0
+    purchased = co_occurrence['incidence'][:, positions]
+    if co_occurrence['is_sparse']:
+        return int((purchased.getnnz(axis=1) > 0).sum())
+    return int(purchased.any(axis=1).sum())
+
+
+# 关联规则：默认最小支持度、最小置信度和最大项集长度
+ASSOCIATION_MIN_SUPPORT = 0.05
+ASSOCIATION_MIN_CONFIDENCE = 0.2
+ASSOCIATION_MAX_LENGTH = 3
+# 每个字节中1的个数（位集计数用的查找表）
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+# 按交易粒度构建 交易×产品 销售额汇总
+def transaction_product_sales(cube, granularity):
+    """granularity 为 '客户' 时每个客户是一笔交易，为 '客户-月份' 时每个客户的每个发运月份是一笔交易"""
+    if granularity == '客户':
+        return cube.groupby(['客户简称', '产品代码'], observed=True)['销售额'].sum()
+    transaction_ids = cube.groupby(['客户简称', '发运月份'], observed=True, dropna=False, sort=False).ngroup()
+    sales = cube.assign(交易编号=transaction_ids.to_numpy()).groupby(['交易编号', '产品代码'], observed=True)['销售额'].sum()
+    return sales.rename_axis(['客户简称', '产品代码'])
+
+
+# 位集Apriori挖掘关联规则
+def mine_association_rules(co_occurrence, min_support=ASSOCIATION_MIN_SUPPORT, max_length=ASSOCIATION_MAX_LENGTH):
+    """
+    在 交易×产品 关联矩阵上挖掘频繁项集：单品支持度取关联矩阵的列和，两项集支持度直接取共现矩阵；
+    三项及以上按Apriori逐层连接、用子集剪枝，支持度通过把每个频繁项集的交易位集（np.packbits）按位与后计数得到。
+    返回单一后项规则 X→y 的支持度、置信度、提升度
+    """
+    products = co_occurrence['products']
+    transaction_count = len(co_occurrence['customers'])
+    columns = ['前项', '后项', '支持度', '置信度', '提升度', '交易数']
+    if transaction_count == 0:
+        return pd.DataFrame(columns=columns)
+    min_count = max(1, int(np.ceil(min_support * transaction_count)))
+
+    item_counts = co_occurrence['product_customers']
+    frequent_items = np.flatnonzero(item_counts >= min_count)
+    supports = {(int(item),): int(item_counts[item]) for item in frequent_items}
+
+    # 两项集：直接读取频繁单品之间的共现次数
+    pair_matrix = co_occurrence['matrix'][frequent_items][:, frequent_items]
+    pair_matrix = pair_matrix.toarray() if co_occurrence['is_sparse'] else np.asarray(pair_matrix)
+    rows, cols = np.nonzero(np.triu(pair_matrix >= min_count, k=1))
+    level = {}
+    for i, j in zip(rows, cols):
+        itemset = (int(frequent_items[i]), int(frequent_items[j]))
+        supports[itemset] = int(pair_matrix[i, j])
+        level[itemset] = None
+
+    # 三项及以上：逐层连接前缀相同的频繁项集，位集按位与计数支持度
+    if max_length >= 3 and level:
+        incidence = co_occurrence['incidence']
+
+        def item_bits(item):
+            if co_occurrence['is_sparse']:
+                column = np.zeros(transaction_count, dtype=bool)
+                column[incidence[:, item].nonzero()[0]] = True
+            else:
+                column = incidence[:, item] > 0
+            return np.packbits(column)
+
+        bits = {item: item_bits(item) for item in {item for itemset in level for item in itemset}}
+        level = {itemset: bits[itemset[0]] & bits[itemset[1]] for itemset in level}
+        for length in range(3, max_length + 1):
+            by_prefix = {}
+            for itemset in sorted(level):
+                by_prefix.setdefault(itemset[:-1], []).append(itemset[-1])
+            next_level = {}
+            for prefix, tails in by_prefix.items():
+                for a in range(len(tails)):
+                    for b in range(a + 1, len(tails)):
+                        candidate = prefix + (tails[a], tails[b])
+                        # 子集剪枝：所有 (k-1) 项子集都必须是频繁项集
+                        if any(candidate[:drop] + candidate[drop + 1:] not in supports for drop in range(length)):
+                            continue
+                        if tails[b] not in bits:
+                            bits[tails[b]] = item_bits(tails[b])
+                        candidate_bits = level[prefix + (tails[a],)] & bits[tails[b]]
+                        count = int(_POPCOUNT_TABLE[candidate_bits].sum())
+                        if count >= min_count:
+                            supports[candidate] = count
+                            next_level[candidate] = candidate_bits
+            if not next_level:
+                break
+            level = next_level
+
+    # 生成单一后项规则 X→y
+    rules = []
+    for itemset, count in supports.items():
+        if len(itemset) < 2:
+            continue
+        for consequent in itemset:
+            antecedent = tuple(item for item in itemset if item != consequent)
+            confidence = count / supports[antecedent]
+            rules.append((
+                tuple(products[list(antecedent)]), products[consequent], count / transaction_count,
+                confidence, confidence / (supports[(consequent,)] / transaction_count), count
+            ))
+    return pd.DataFrame(rules, columns=columns).sort_values(['提升度', '支持度'], ascending=False, ignore_index=True)
+
+
+# 热力图最多展示的单元格数，超过时只保留合计值最高的行列
+HEATMAP_MAX_CELLS = 400
+
+
+# 热力图的行列上限
+def _heatmap_limits(n_rows, n_cols, max_cells, symmetric):
+    if n_rows * n_cols <= max_cells:
+        return n_rows, n_cols
+    side = max(1, int(np.sqrt(max_cells)))
+    if symmetric:
+        return side, side
+    if n_rows <= side:
+        return n_rows, max(1, max_cells // n_rows)
+    if n_cols <= side:
+        return max(1, max_cells // n_cols), n_cols
+    return side, side
+
+
+# 选取合计值最高的标签（pinned中的标签优先保留）
+def _top_labels(labels, totals, limit, pinned):
+    pinned_set = set(pinned)
+    pinned = [label for label in labels if label in pinned_set][:limit]
+    ranked = [label for label in pd.Series(totals, index=labels).sort_values(ascending=False, kind='stable').index
+              if label not in pinned_set]
+    keep = set(pinned + ranked[:limit - len(pinned)])
+    return [label for label in labels if label in keep]
+
+
+# 创建热力图
+def build_heatmap(matrix, texttemplate, hide_zero=False, max_cells=HEATMAP_MAX_CELLS, pinned=(), x=None, y=None,
+                  **imshow_kwargs):
+    """
+    单元格数值作为热力图自身的文本层（texttemplate）一次性输出，不再逐格添加注释；hide_zero 时零值单元格留空。
+    单元格数超过max_cells时只保留行/列合计值最高的部分（行列标签相同的方阵取同一组标签，pinned中的标签优先保留），
+    x/y 为显示用的行列名称映射。返回 (图表, 是否截断)
+    """
+    values = matrix.abs()
+    symmetric = list(matrix.index) == list(matrix.columns)
+    row_limit, col_limit = _heatmap_limits(len(matrix.index), len(matrix.columns), max_cells, symmetric)
+    truncated = row_limit < len(matrix.index) or col_limit < len(matrix.columns)
+    if truncated:
+        if symmetric:
+            rows = cols = _top_labels(list(matrix.index), values.sum(axis=1) + values.sum(axis=0), row_limit, pinned)
+        else:
+            rows = _top_labels(list(matrix.index), values.sum(axis=1), row_limit, pinned)
+            cols = _top_labels(list(matrix.columns), values.sum(axis=0), col_limit, pinned)
+        matrix = matrix.loc[rows, cols]
+
+    fig = px.imshow(
+        matrix,
+        x=[x.get(label, label) for label in matrix.columns] if x is not None else list(matrix.columns),
+        y=[y.get(label, label) for label in matrix.index] if y is not None else list(matrix.index),
+        **imshow_kwargs
+    )
+    if hide_zero:
+        # 零值单元格不显示文本（非零单元格直接显示原始数值）
+        cells = matrix.to_numpy()
+        fig.update_traces(text=np.where(cells != 0, cells.astype(str), ''), texttemplate='%{text}')
+    else:
+        fig.update_traces(texttemplate=texttemplate)
+    return fig, truncated
+
+
+# 计算客户特征
+def compute_customer_features(registry):
+    """客户细分模块的计算部分：按客户汇总销售特征、新品占比和客户类型"""
+    # 计算客户特征
+    customer_features = get_aggregate_table(registry, '全部', '客户简称', [
+        ('销售额', '销售额', 'sum'),  # 总销售额
+        ('产品代码', '产品代码', 'nunique'),  # 购买的不同产品数量
+        ('数量（箱）', '数量（箱）', 'sum'),  # 总购买数量
+        ('单价合计', '单价合计', 'sum'),
+        ('单价计数', '单价计数', 'sum')
+    ])
+    # 平均单价 = 单价合计 / 单价计数（与按明细行求平均一致）
+    customer_features['单价（箱）'] = customer_features['单价合计'] / customer_features['单价计数']
+    customer_features = customer_features.drop(columns=['单价合计', '单价计数'])
+
+    # 添加新品购买指标
+    new_products_by_customer = get_aggregate(registry, '新品', '客户简称').reset_index()
+    customer_features = customer_features.merge(new_products_by_customer, on='客户简称', how='left',
+                                                suffixes=('', '_新品'))
+    customer_features['销售额_新品'] = customer_features['销售额_新品'].fillna(0)
+    customer_features['新品占比'] = customer_features['销售额_新品'] / customer_features['销售额'] * 100
+
+    # RFM特征：最近购买间隔（距筛选范围内最后一个月的月数）、活跃月数、订单行数，销售额即消费金额
+    rfm = get_aggregate_table(registry, '全部', '客户简称', [
+        ('最近购买月份', '发运月份', 'max'),
+        ('活跃月数', '发运月份', 'nunique'),
+        ('订单行数', '行数', 'sum')
+    ])
+    last_month = pd.to_datetime(rfm['最近购买月份'], errors='coerce')
+    month_index = last_month.dt.year * 12 + last_month.dt.month
+    rfm['最近购买间隔'] = month_index.max() - month_index
+    customer_features = customer_features.merge(rfm.drop(columns=['最近购买月份']), on='客户简称', how='left')
+
+    # 简单客户分类（include_lowest 保证新品占比为0%的客户归入保守型）
+    customer_features['客户类型'] = pd.cut(
+        customer_features['新品占比'],
+        bins=[0, 10, 30, 100],
+        labels=['保守型客户', '平衡型客户', '创新型客户'],
+        include_lowest=True
+    )
+    return customer_features
+
+
+# 客户聚类可选的特征，以及聚类前先做对数变换的长尾特征
+SEGMENT_FEATURES = ['最近购买间隔', '活跃月数', '销售额', '订单行数', '产品代码', '新品占比']
+SEGMENT_DEFAULT_FEATURES = ['最近购买间隔', '活跃月数', '销售额']
+SEGMENT_LOG_FEATURES = ['活跃月数', '销售额', '订单行数', '产品代码']
+SEGMENT_FEATURE_LABELS = {'产品代码': '购买产品种类数'}
+
+
+# k-means拟合簇中心时最多使用的样本数，客户更多时在随机样本上拟合，再把全部客户分配到最近的中心
+KMEANS_SAMPLE_SIZE = 20000
+
+
+# NumPy k-means聚类
+def kmeans(features, k, max_iter=50, tol=1e-4, seed=0, sample_size=KMEANS_SAMPLE_SIZE):
+    """
+    k-means++初始化加Lloyd迭代，距离和中心更新都是NumPy向量化计算，固定随机种子保证结果可复现。
+    返回 (每行的簇编号, 簇中心)
+    """
+    rng = np.random.default_rng(seed)
+    sample = features[rng.choice(len(features), sample_size, replace=False)] if len(features) > sample_size else features
+    n, dims = sample.shape
+    k = max(1, min(k, n))
+
+    centers = np.empty((k, dims), dtype=features.dtype)
+    centers[0] = sample[rng.integers(n)]
+    closest = ((sample - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        total = closest.sum()
+        centers[i] = sample[rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)]
+        closest = np.minimum(closest, ((sample - centers[i]) ** 2).sum(axis=1))
+
+    def assign(points, centers):
+        # |x-c|² = |x|² - 2x·c + |c|²，|x|² 对每一行是常数，不影响取最小值
+        return ((centers ** 2).sum(axis=1)[None, :] - 2 * points @ centers.T).argmin(axis=1)
+
+    for _ in range(max_iter):
+        labels = assign(sample, centers)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=sample[:, j], minlength=k) for j in range(dims)], axis=1)
+        # 空簇保留原来的中心
+        new_centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        shift = ((new_centers - centers) ** 2).sum()
+        centers = new_centers.astype(features.dtype)
+        if shift <= tol:
+            break
+    return assign(features, centers), centers
+
+
+# 客户聚类细分
+def segment_customers(customer_features, features, k):
+    """
+    对所选特征做对数变换（长尾特征）和标准化后进行k-means聚类，簇按平均销售额从高到低命名为"群组1"、"群组2"…。
+    返回 (每个客户的群组, 各群组的特征均值)
+    """
+    values = customer_features[features].astype(float).fillna(0)
+    for feature in features:
+        if feature in SEGMENT_LOG_FEATURES:
+            values[feature] = np.log1p(values[feature].clip(lower=0))
+    matrix = values.to_numpy()
+    std = matrix.std(axis=0)
+    # 标准化后转为float32，距离计算的矩阵乘法和取最小值都快一倍
+    matrix = ((matrix - matrix.mean(axis=0)) / np.where(std > 0, std, 1)).astype(np.float32)
+
+    labels, centers = kmeans(matrix, k)
+    counts = np.bincount(labels, minlength=len(centers))
+    mean_sales = np.bincount(labels, weights=customer_features['销售额'].fillna(0).to_numpy(dtype=float),
+                             minlength=len(centers)) / np.maximum(counts, 1)
+    # 按平均销售额排名重新编号（空簇排在最后）
+    order = np.lexsort((-mean_sales, counts == 0))
+    ranks = np.empty(len(centers), dtype=np.int64)
+    ranks[order] = np.arange(len(centers))
+    used = int((counts > 0).sum())
+    segments = pd.Series(pd.Categorical.from_codes(
+        ranks[labels], categories=[f"群组{rank + 1}" for rank in range(used)]
+    ), index=customer_features.index, name='聚类群组')
+
+    profile_columns = list(dict.fromkeys(SEGMENT_DEFAULT_FEATURES + features))
+    profile = customer_features[profile_columns].groupby(segments, observed=True).mean().round(2)
+    profile.insert(0, '客户数', segments.value_counts().reindex(profile.index))
+    return segments, profile.reset_index().rename(columns=SEGMENT_FEATURE_LABELS)
+
+
+# 月度汇总存储的维度（客户以集合形式保存在每个格子中）
+ROLLUP_DIMENSIONS = ['所属区域', '产品代码', '申请人']
+# 同比对应的间隔期数
+YOY_LAGS = {'M': 12, 'Q': 4, 'Y': 1}
+
+
+# 汇总月度存储
+def rollup_monthly(cube):
+    """
+    按 月份×区域×产品×申请人 汇总销售额和数量，并保存每个格子的客户集合：
+    集合以去重后的 (格子编号, 客户编号) 整数对保存，查询不同客户数时只需对整数对去重计数
+    """
+    months = pd.to_datetime(cube['发运月份'], errors='coerce').dt.to_period('M')
+    valid = months.notna().to_numpy()
+    customer_codes, customers = pd.factorize(cube['客户简称'][valid])
+    flag_columns = [col for col in ['是否新品'] if col in cube.columns]
+    frame = pd.DataFrame({
+        '月份': months[valid].to_numpy(),
+        **{dimension: cube[dimension][valid].astype(str).to_numpy() for dimension in ROLLUP_DIMENSIONS},
+        **{col: cube[col][valid].to_numpy() for col in flag_columns},
+        '销售额': cube['销售额'][valid].to_numpy(),
+        '数量（箱）': cube['数量（箱）'][valid].to_numpy()
+    })
+
+    # 新品标记由产品和月份决定，作为分组键不会增加格子数
+    grouped = frame.groupby(['月份'] + ROLLUP_DIMENSIONS + flag_columns, sort=True)
+    cells = grouped[['销售额', '数量（箱）']].sum().reset_index()
+    cell_ids = grouped.ngroup().to_numpy()
+
+    customer_count = max(len(customers), 1)
+    pair_keys = np.unique(cell_ids.astype(np.int64) * customer_count + customer_codes)
+    return {
+        'cells': cells,
+        'pair_cells': (pair_keys // customer_count).astype(np.int64),
+        'pair_customers': (pair_keys % customer_count).astype(np.int64),
+        'customers': pd.Index(customers)
+    }
+
+
+# 构建月度汇总存储
+@st.cache_resource(max_entries=8)
+def build_monthly_rollup(version, _cube):
+    """按数据集版本在加载后构建一次，趋势查询都在该存储上完成，不再扫描发货明细"""
+    return rollup_monthly(_cube)
+
+
+# 查询月度汇总存储
+def query_monthly_rollup(rollup, selections=None, freq='M', by=None, new_only=False):
+    """
+    按筛选条件返回各周期（freq 为 'M'/'Q'/'Y'）的销售额、数量和不同客户数，by 为可选的细分维度，
+    new_only 为True时只统计标记为新品的格子。不细分时补齐中间没有数据的周期（记为0），便于计算环比/同比
+    """
+    cells = rollup['cells']
+    mask = np.ones(len(cells), dtype=bool)
+    for dimension, values in (selections or {}).items():
+        if dimension in ROLLUP_DIMENSIONS and values:
+            mask &= cells[dimension].isin([str(value) for value in values]).to_numpy()
+    if new_only:
+        mask &= cells['是否新品'].to_numpy() == 1
+
+    selected = cells[mask]
+    periods = selected['月份'] if freq == 'M' else selected['月份'].dt.asfreq(freq)
+    keys = [periods.rename('周期')] + ([selected[by]] if by else [])
+    grouped = selected.groupby(keys, sort=True)
+    result = grouped[['销售额', '数量（箱）']].sum()
+
+    # 不同客户数：对 (分组, 客户) 整数对去重后按分组计数
+    group_ids = np.full(len(cells), -1, dtype=np.int64)
+    group_ids[mask] = grouped.ngroup().to_numpy()
+    pair_groups = group_ids[rollup['pair_cells']]
+    keep = pair_groups >= 0
+    customer_count = max(len(rollup['customers']), 1)
+    group_customers = np.unique(pair_groups[keep] * customer_count + rollup['pair_customers'][keep])
+    result['客户数'] = np.bincount(group_customers // customer_count, minlength=len(result))
+    result = result.reset_index()
+
+    if by is None and len(result):
+        full_range = pd.period_range(result['周期'].min(), result['周期'].max(), freq=freq)
+        result = result.set_index('周期').reindex(full_range, fill_value=0).rename_axis('周期').reset_index()
+    return result
+
+
+# 计算环比和同比增长率
+def add_period_growth(series, freq, column='销售额'):
+    """在按周期排列的汇总表上添加环比、同比增长率（%），上期为0时记为空值"""
+    previous = series[column].shift(1)
+    last_year = series[column].shift(YOY_LAGS[freq])
+    series['环比增长率'] = ((series[column] - previous) / previous.where(previous != 0) * 100).round(2)
+    series['同比增长率'] = ((series[column] - last_year) / last_year.where(last_year != 0) * 100).round(2)
+    return series
+
+
+# HyperLogLog 精度：每个草图 2^p 个寄存器，相对标准误差约 1.04/√(2^p)，p=10 时约3.25%。
+# 内存上限：非空寄存器不超过 2^p/4 个的格子只保存 (寄存器, 取值) 对（每对2字节），超过后才展开为 2^p 字节的稠密寄存器，
+# 因此草图总内存不超过 4字节×(格子, 客户)整数对数，另加每个格子8字节的偏移量，不随精度和格子数放大
+HLL_PRECISION = 10
+# 寄存器值 r 对应的 2^-r（估算时查表）
+_HLL_INVERSE_POWERS = 2.0 ** -np.arange(65)
+
+
+# 64位整数的有效位数
+def _bit_length(values):
+    values = values.astype(np.uint64)
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        values = np.where(high, values >> np.uint64(shift), values)
+        lengths += high * shift
+    return lengths + (values > 0)
+
+
+# 计算客户的HyperLogLog寄存器位置和取值
+def _hll_positions(customers, precision=HLL_PRECISION):
+    """对每个客户名称取64位哈希：高 p 位决定寄存器位置，其余位的前导零个数+1为写入该寄存器的值"""
+    hashes = pd.util.hash_array(np.asarray(customers, dtype=object))
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    remainder = hashes << np.uint64(precision)
+    ranks = np.minimum(64 - _bit_length(remainder) + 1, 64 - precision + 1).astype(np.uint8)
+    return registers, ranks
+
+
+# 由寄存器估算不同客户数
+def estimate_distinct_count(registers):
+    """对每一行寄存器按HyperLogLog公式估算基数，小基数（估算值不超过2.5m且有空寄存器）时改用线性计数"""
+    registers = np.atleast_2d(registers)
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / _HLL_INVERSE_POWERS[registers].sum(axis=1)
+    empty = (registers == 0).sum(axis=1)
+    small = (estimate <= 2.5 * m) & (empty > 0)
+    estimate[small] = m * np.log(m / empty[small])
+    return np.round(estimate).astype(np.int64)
+
+
+# 构建 区域×月份×产品 的客户草图
+def sketch_customers(rollup, precision=HLL_PRECISION):
+    """
+    在月度汇总存储的 (格子, 客户) 整数对上为每个 月份×区域×产品 格子建立HyperLogLog草图，
+    草图可以按位取最大值合并，任意区域/产品/月份组合的不同客户数都由合并后的寄存器估算。
+    客户少的格子以稀疏形式保存：按格子排列的 (寄存器<<6 | 取值) 编码加偏移量；
+    非空寄存器超过 2^p/4 个的格子才展开为稠密寄存器行
+    """
+    cells = rollup['cells']
+    keys = ['月份', '所属区域', '产品代码'] + [col for col in ['是否新品'] if col in cells.columns]
+    grouped = cells.groupby(keys, sort=True)
+    sketch_cells = grouped.size().reset_index()[keys]
+    sketch_ids = grouped.ngroup().to_numpy()
+
+    positions, ranks = _hll_positions(rollup['customers'], precision)
+    m = 1 << precision
+    customers = rollup['pair_customers']
+
+    # 每个格子的每个寄存器只保留最大取值
+    entry_keys = sketch_ids[rollup['pair_cells']] * m + positions[customers]
+    entry_ranks = ranks[customers]
+    order = np.lexsort((entry_ranks, entry_keys))
+    entry_keys, entry_ranks = entry_keys[order], entry_ranks[order]
+    last = np.ones(len(entry_keys), dtype=bool)
+    last[:-1] = entry_keys[1:] != entry_keys[:-1]
+    entry_keys, entry_ranks = entry_keys[last], entry_ranks[last]
+    entry_cells = entry_keys // m
+    entry_positions = entry_keys % m
+
+    # 非空寄存器超过 m/4 个的格子展开为稠密寄存器
+    counts = np.bincount(entry_cells, minlength=len(sketch_cells))
+    dense = counts > m // 4
+    dense_cells = np.flatnonzero(dense)
+    dense_rows = np.full(len(sketch_cells), -1, dtype=np.int64)
+    dense_rows[dense_cells] = np.arange(len(dense_cells))
+    dense_registers = np.zeros((len(dense_cells), m), dtype=np.uint8)
+    in_dense = dense[entry_cells]
+    dense_registers[dense_rows[entry_cells[in_dense]], entry_positions[in_dense]] = entry_ranks[in_dense]
+
+    # 其余格子保存 (寄存器, 取值) 编码，取值不超过 65-p，占低6位
+    entry_dtype = np.uint16 if precision <= 10 else np.uint32
+    sparse_entries = ((entry_positions[~in_dense] << 6) | entry_ranks[~in_dense]).astype(entry_dtype)
+    sparse_offsets = np.zeros(len(sketch_cells) + 1, dtype=np.int64)
+    np.cumsum(np.where(dense, 0, counts), out=sparse_offsets[1:])
+    return {
+        'cells': sketch_cells,
+        'sparse_entries': sparse_entries,
+        'sparse_offsets': sparse_offsets,
+        'dense_cells': dense_cells,
+        'dense_registers': dense_registers,
+        'precision': precision,
+        'nbytes': sparse_entries.nbytes + sparse_offsets.nbytes + dense_cells.nbytes + dense_registers.nbytes
+    }
+
+
+# 按分组合并客户草图
+def _merge_customer_sketches(sketches, cell_groups, n_groups):
+    """cell_groups 为每个格子所属的分组编号（-1 表示不参与合并），返回每个分组合并后的稠密寄存器"""
+    m = 1 << sketches['precision']
+    merged = np.zeros((n_groups, m), dtype=np.uint8)
+
+    # 稀疏格子：把 (寄存器, 取值) 对写入所属分组
+    entry_groups = np.repeat(cell_groups, np.diff(sketches['sparse_offsets']))
+    keep = entry_groups >= 0
+    entries = sketches['sparse_entries'][keep].astype(np.int64)
+    np.maximum.at(merged.reshape(-1), entry_groups[keep] * m + (entries >> 6), (entries & 63).astype(np.uint8))
 
-        return simple_df
+    # 稠密格子：整行按位取最大值
+    dense_groups = cell_groups[sketches['dense_cells']]
+    keep = dense_groups >= 0
+    np.maximum.at(merged, dense_groups[keep], sketches['dense_registers'][keep])
+    return merged
+
+
+# 构建客户草图
+@st.cache_resource(max_entries=8)
+def build_customer_sketches(version, _rollup):
+    """按数据集版本构建一次，切换筛选条件时只合并草图"""
+    return sketch_customers(_rollup)
+
+
+# 查询客户草图
+def query_customer_sketches(sketches, selections=None, by=None, new_only=False):
+    """
+    按区域/产品筛选条件合并草图并估算不同客户数，new_only 为True时只合并新品格子。by 为空时返回一个整数，
+    为 '所属区域' 或 '月份' 时返回按该维度分组的估算值（Series）
+    """
+    cells = sketches['cells']
+    mask = np.ones(len(cells), dtype=bool)
+    for dimension in ('所属区域', '产品代码'):
+        values = (selections or {}).get(dimension)
+        if values:
+            mask &= cells[dimension].isin([str(value) for value in values]).to_numpy()
+    if new_only:
+        mask &= cells['是否新品'].to_numpy() == 1
+
+    cell_groups = np.full(len(cells), -1, dtype=np.int64)
+    if by is None:
+        if not mask.any():
+            return 0
+        cell_groups[mask] = 0
+        return int(estimate_distinct_count(_merge_customer_sketches(sketches, cell_groups, 1))[0])
+
+    group_codes, groups = pd.factorize(cells[by][mask], sort=True)
+    if not len(groups):
+        return pd.Series(dtype=np.int64, index=pd.Index(groups, name=by), name='客户数')
+    cell_groups[mask] = group_codes
+    merged = _merge_customer_sketches(sketches, cell_groups, len(groups))
+    return pd.Series(estimate_distinct_count(merged), index=pd.Index(groups, name=by), name='客户数')
+
+
+# 计算月度新品渗透率
+def compute_monthly_penetration(rollup, selections, sketches=None):
+    """
+    市场渗透率模块的计算部分：从月度汇总存储按月取客户总数、购买新品客户数并计算渗透率，
+    传入客户草图时不同客户数改为HyperLogLog估算值
+    """
+    if sketches is None:
+        monthly_customers = query_monthly_rollup(rollup, selections)[['周期', '客户数']]
+        monthly_new_customers = query_monthly_rollup(rollup, selections, new_only=True)[['周期', '客户数']]
+    else:
+        monthly_customers = query_customer_sketches(sketches, selections, by='月份')
+        if len(monthly_customers):
+            full_range = pd.period_range(monthly_customers.index.min(), monthly_customers.index.max(), freq='M')
+            monthly_customers = monthly_customers.reindex(full_range, fill_value=0)
+        monthly_customers = monthly_customers.rename_axis('周期').reset_index()
+        monthly_new_customers = query_customer_sketches(
+            sketches, selections, by='月份', new_only=True
+        ).rename_axis('周期').reset_index()
+    monthly_customers.columns = ['周期', '客户总数']
+    monthly_new_customers.columns = ['周期', '购买新品客户数']
+
+    # 合并月度数据
+    monthly_penetration = monthly_customers.merge(monthly_new_customers, on='周期', how='left')
+    monthly_penetration['购买新品客户数'] = monthly_penetration['购买新品客户数'].fillna(0)
+    monthly_penetration['渗透率'] = (
+            monthly_penetration['购买新品客户数'] / monthly_penetration['客户总数'] * 100).round(2)
+    monthly_penetration['月份'] = monthly_penetration['周期'].dt.to_timestamp()
+    monthly_penetration['月份_str'] = monthly_penetration['周期'].dt.strftime('%Y-%m')
+    return monthly_penetration.drop(columns=['周期'])
+
+
+# 价格-销量散点图的渲染方式切换阈值（行数）：超过前者改用WebGL，超过后者改为服务端二维分箱
+SCATTER_WEBGL_THRESHOLD = 5000
+SCATTER_BINNING_THRESHOLD = 200000
+# 二维分箱时单价、数量两个方向各分多少格
+SCATTER_BINS = 50
+
+
+# 选择价格-销量散点图的渲染方式
+def price_quantity_render_mode(row_count):
+    if row_count > SCATTER_BINNING_THRESHOLD:
+        return 'binned'
+    if row_count > SCATTER_WEBGL_THRESHOLD:
+        return 'webgl'
+    return 'svg'
+
+
+# 价格-销量二维分箱
+def bin_price_quantity(df, bins=SCATTER_BINS):
+    """
+    按 单价×数量 把明细行分到 bins×bins 的网格中，再按区域汇总每个非空格子的行数和销售额，
+    输出的点数最多为 区域数×bins²，与明细行数无关。格子用中心点坐标表示
+    """
+    points = df[['所属区域', '单价（箱）', '数量（箱）', '销售额']].dropna(subset=['单价（箱）', '数量（箱）'])
+    price = points['单价（箱）'].to_numpy(dtype=float)
+    quantity = points['数量（箱）'].to_numpy(dtype=float)
+    if len(points) == 0:
+        return pd.DataFrame(columns=['所属区域', '单价（箱）', '数量（箱）', '销售额', '行数'])
+
+    def bin_index(values):
+        low, high = values.min(), values.max()
+        width = (high - low) / bins if high > low else 1.0
+        index = np.minimum(((values - low) / width).astype(np.int64), bins - 1)
+        return index, low + (index + 0.5) * width
+
+    price_bin, price_center = bin_index(price)
+    quantity_bin, quantity_center = bin_index(quantity)
+    binned = pd.DataFrame({
+        '所属区域': points['所属区域'].to_numpy(),
+        '价格格': price_bin,
+        '数量格': quantity_bin,
+        '单价（箱）': price_center,
+        '数量（箱）': quantity_center,
+        '销售额': points['销售额'].to_numpy(dtype=float)
+    }).groupby(['所属区域', '价格格', '数量格'], observed=True, sort=False).agg(
+        单价=('单价（箱）', 'first'),
+        数量=('数量（箱）', 'first'),
+        销售额=('销售额', 'sum'),
+        行数=('销售额', 'size')
+    ).reset_index()
+    return binned.rename(columns={'单价': '单价（箱）', '数量': '数量（箱）'}).drop(columns=['价格格', '数量格'])
 
 
 # 定义默认文件路径
@@ -343,37 +1719,85 @@ DEFAULT_FILE_PATH = "Q1xlsx.xlsx"
 # 侧边栏 - 上传文件区域
 st.sidebar.markdown('<div class="sidebar-header">数据导入</div>', unsafe_allow_html=True)
 use_default_file = st.sidebar.checkbox("使用默认文件", value=True, help="使用指定的本地文件路径")
-uploaded_file = st.sidebar.file_uploader("或上传Excel销售数据文件", type=["xlsx", "xls"], disabled=use_default_file)
+uploaded_files = st.sidebar.file_uploader("或上传Excel销售数据文件（可多选）", type=["xlsx", "xls"],
+                                          accept_multiple_files=True, disabled=use_default_file)
+workbook_pattern = st.sidebar.text_input("或输入工作簿目录/通配符", value="", disabled=use_default_file,
+                                         help="例如 data/ 或 data/*Q*.xlsx，多个工作簿将并行解析后合并")
+incremental_mode = st.sidebar.checkbox("增量模式", value=False, disabled=use_default_file,
+                                       help="按发运月份分区持久化，新数据到达时只解析新增或变化的工作簿")
+compact_mode = st.sidebar.checkbox("紧凑内存模式", value=False,
+                                   help="维度列使用分类类型、数值列无损向下转换，显著降低内存占用并加快分组计算")
 
 # 加载数据
+load_start = time.perf_counter()
 if use_default_file:
     # 使用默认文件路径
     if os.path.exists(DEFAULT_FILE_PATH):
-        df = load_data(DEFAULT_FILE_PATH)
+        df = load_data(DEFAULT_FILE_PATH, compact=compact_mode)
         st.sidebar.success(f"已成功加载默认文件: {DEFAULT_FILE_PATH}")
     else:
         st.sidebar.error(f"默认文件路径不存在: {DEFAULT_FILE_PATH}")
-        df = load_sample_data()
+        df = load_sample_data(compact=compact_mode)
+        st.sidebar.info("正在使用示例数据。请上传您的数据文件获取真实分析。")
+elif uploaded_files:
+    # 使用上传的文件（一个或多个）
+    df = load_uploaded_files(uploaded_files, compact=compact_mode)
+elif workbook_pattern.strip():
+    # 使用目录或通配符匹配的多个工作簿
+    workbook_paths = expand_workbook_sources(workbook_pattern)
+    if workbook_paths:
+        workbook_sources = tuple(
+            (os.path.abspath(path), os.path.getsize(path), os.stat(path).st_mtime_ns) for path in workbook_paths
+        )
+        if incremental_mode:
+            df = load_incremental_workbooks(workbook_sources, compact=compact_mode)
+        else:
+            df = load_workbook_files(workbook_sources, compact=compact_mode)
+        st.sidebar.success(f"已合并加载{len(workbook_paths)}个工作簿")
+        if 'incremental_stats' in df.attrs:
+            stats = df.attrs['incremental_stats']
+            st.sidebar.caption(f"增量模式：重新解析{stats['parsed']}个工作簿，复用{stats['reused']}个工作簿的分区")
+    else:
+        st.sidebar.error(f"没有找到匹配的工作簿: {workbook_pattern}")
+        df = load_sample_data(compact=compact_mode)
         st.sidebar.info("正在使用示例数据。请上传您的数据文件获取真实分析。")
-elif uploaded_file is not None:
-    # 使用上传的文件
-    df = load_data(uploaded_file)
 else:
     # 没有文件，使用示例数据
-    df = load_sample_data()
+    df = load_sample_data(compact=compact_mode)
     st.sidebar.info("正在使用示例数据。请上传您的数据文件获取真实分析。")
 
-# 定义新品产品代码
-new_products = ['F0110C', 'F0183F', 'F01K8A', 'F0183K', 'F0101P']
-new_products_df = df[df['产品代码'].isin(new_products)]
+_record_startup_timing('加载数据', load_start)
 
-# 创建产品代码到简化名称的映射字典（用于图表显示）
-product_name_mapping = {
-    code: df[df['产品代码'] == code]['简化产品名称'].iloc[0] if len(df[df['产品代码'] == code]) > 0 else code
-    for code in df['产品代码'].unique()
-}
+# 紧凑模式下报告节省的内存
+if compact_mode and 'memory_before' in df.attrs:
+    memory_before = df.attrs['memory_before']
+    memory_after = df.attrs['memory_after']
+    saved_ratio = (1 - memory_after / memory_before) * 100 if memory_before > 0 else 0
+    st.sidebar.caption(
+        f"紧凑模式内存占用：{memory_before / 1024 ** 2:.2f}MB → {memory_after / 1024 ** 2:.2f}MB"
+        f"（节省{saved_ratio:.1f}%）"
+    )
+
+# 新品目录
+new_product_catalogue = load_new_product_catalogue()
+
+# 数据集版本（筛选索引、汇总立方体、产品维度表和聚合登记表都按该版本缓存），
+# 包含新品目录的版本，目录变化时新品标记和各派生结构一起失效
+dataset_version = df.attrs.get('dataset_version') or finalize_sales_frame(df).attrs['dataset_version']
+dataset_version = f"{dataset_version}:{new_product_catalogue_version(new_product_catalogue)}"
+
+# 行级新品标记（int8数组，加载后按版本计算一次；df可能是跨会话共享的缓存对象，不把标记写回df）
+new_product_flags = build_new_product_flags(dataset_version, df, new_product_catalogue)
+
+# 产品维度表与新品产品代码
+product_dimension = build_product_dimension(dataset_version, df, new_product_flags)
+new_products = product_dimension.index[product_dimension['是否新品']].tolist()
+
+# 产品代码到简化名称的映射（用于图表显示）
+product_name_mapping = product_dimension['简化产品名称']
 
 # 侧边栏 - 筛选器
+filter_start = time.perf_counter()
 st.sidebar.markdown('<div class="sidebar-header">筛选数据</div>', unsafe_allow_html=True)
 
 # 区域筛选器
@@ -385,12 +1809,11 @@ all_customers = sorted(df['客户简称'].astype(str).unique())
 selected_customers = st.sidebar.multiselect("选择客户", all_customers, default=[])
 
 # 产品代码筛选器
-all_products = sorted(df['产品代码'].astype(str).unique())
-product_options = [(code, product_name_mapping[code]) for code in all_products]
+all_products = sorted(product_dimension.index)
 selected_products = st.sidebar.multiselect(
     "选择产品",
     options=all_products,
-    format_func=lambda x: f"{x} ({product_name_mapping[x]})",
+    format_func=lambda x: f"{x} ({product_name_mapping.get(x, x)})",
     default=[]
 )
 
@@ -398,35 +1821,59 @@ selected_products = st.sidebar.multiselect(
 all_applicants = sorted(df['申请人'].astype(str).unique())
 selected_applicants = st.sidebar.multiselect("选择申请人", all_applicants, default=[])
 
-# 应用筛选条件
-filtered_df = df.copy()
-
-if selected_regions:
-    filtered_df = filtered_df[filtered_df['所属区域'].isin(selected_regions)]
+# 应用筛选条件 - 使用预先计算的行号索引，只对最终结果做一次take，不复制整个数据表
+filter_index = build_filter_index(dataset_version, df)
+filter_selections = {
+    '所属区域': selected_regions,
+    '客户简称': selected_customers,
+    '产品代码': selected_products,
+    '申请人': selected_applicants
+}
+filtered_row_ids = filter_row_ids(filter_index, filter_selections)
+filtered_df = take_filtered_rows(df, filtered_row_ids)
+
+# 根据筛选后的行号和新品标记取出新品数据
+filtered_new_products_df = take_filtered_rows(df, flagged_row_ids(filtered_row_ids, new_product_flags))
+
+# 在汇总立方体上应用相同的筛选条件，图表的分组查询都基于筛选后的立方体
+sales_cube = build_sales_cube(dataset_version, df, new_product_flags)
+cube_filter_index = build_filter_index(f"{dataset_version}:cube", sales_cube)
+filtered_cube_row_ids = filter_row_ids(cube_filter_index, filter_selections)
+filtered_cube = take_filtered_rows(sales_cube, filtered_cube_row_ids)
+filtered_new_cube = take_filtered_rows(
+    sales_cube, flagged_row_ids(filtered_cube_row_ids, sales_cube['是否新品'].to_numpy())
+)
 
-if selected_customers:
-    filtered_df = filtered_df[filtered_df['客户简称'].isin(selected_customers)]
+# 本轮运行的聚合登记表，相同的分组汇总只计算一次
+aggregate_registry = get_aggregate_registry(
+    dataset_version, normalize_filter_state(filter_selections), {'全部': filtered_cube, '新品': filtered_new_cube}
+)
 
-if selected_products:
-    filtered_df = filtered_df[filtered_df['产品代码'].isin(selected_products)]
+_record_startup_timing('筛选数据', filter_start)
 
-if selected_applicants:
-    filtered_df = filtered_df[filtered_df['申请人'].isin(selected_applicants)]
+# 月度汇总存储：按数据集版本构建一次；选择了客户时改由筛选后的立方体汇总（按筛选状态缓存）
+if selected_customers:
+    monthly_rollup = get_cached_result(aggregate_registry, 'monthly_rollup', lambda: rollup_monthly(filtered_cube))
+else:
+    monthly_rollup = build_monthly_rollup(dataset_version, sales_cube)
 
-# 根据筛选后的数据筛选新品数据
-filtered_new_products_df = filtered_df[filtered_df['产品代码'].isin(new_products)]
+# 多个分析模块共用的指标（在模块之外计算，切换模块时直接复用）
+total_sales = get_aggregate(aggregate_registry, '全部')
 
-# 导航栏
+# 导航栏 - 只计算和渲染当前选中的分析模块，其余模块的分析和图表不执行；
+# 各模块的汇总结果来自聚合登记表和按筛选状态缓存的计算结果，切回时直接命中缓存
+ANALYSIS_SECTIONS = ["销售概览", "新品分析", "客户细分", "产品组合", "市场渗透率", "销售趋势"]
 st.markdown('<div class="sub-header">导航</div>', unsafe_allow_html=True)
-tabs = st.tabs(["销售概览", "新品分析", "客户细分", "产品组合", "市场渗透率"])
+active_section = st.radio(
+    "选择分析模块", ANALYSIS_SECTIONS, horizontal=True, label_visibility="collapsed", key='active_section'
+)
 
-with tabs[0]:  # 销售概览
+if active_section == '销售概览':
     # KPI指标行
     st.markdown('<div class="sub-header"> 🔑 关键绩效指标</div>', unsafe_allow_html=True)
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        total_sales = filtered_df['销售额'].sum()
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">总销售额</div>
@@ -435,7 +1882,7 @@ with tabs[0]:  # 销售概览
         """, unsafe_allow_html=True)
 
     with col2:
-        total_customers = filtered_df['客户简称'].nunique()
+        total_customers = get_aggregate(aggregate_registry, '全部', column='客户简称', func='nunique')
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">客户数量</div>
@@ -444,7 +1891,7 @@ with tabs[0]:  # 销售概览
         """, unsafe_allow_html=True)
 
     with col3:
-        total_products = filtered_df['产品代码'].nunique()
+        total_products = get_aggregate(aggregate_registry, '全部', column='产品代码', func='nunique')
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">产品数量</div>
@@ -453,7 +1900,8 @@ with tabs[0]:  # 销售概览
         """, unsafe_allow_html=True)
 
     with col4:
-        avg_price = filtered_df['单价（箱）'].mean()
+        price_count = get_aggregate(aggregate_registry, '全部', column='单价计数')
+        avg_price = get_aggregate(aggregate_registry, '全部', column='单价合计') / price_count if price_count > 0 else np.nan
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">平均单价</div>
@@ -461,13 +1909,15 @@ with tabs[0]:  # 销售概览
         </div>
         """, unsafe_allow_html=True)
 
+    _record_startup_timing('首屏KPI卡片（自脚本开始）', _SCRIPT_START)
+
     # 区域销售分析
     st.markdown('<div class="sub-header section-gap"> 📊 区域销售分析</div>', unsafe_allow_html=True)
     col1, col2 = st.columns(2)
 
     with col1:
         # 区域销售额柱状图 - 使用go.Figure和go.Bar代替px.bar以修复标签问题
-        region_sales = filtered_df.groupby('所属区域')['销售额'].sum().reset_index()
+        region_sales = get_aggregate(aggregate_registry, '全部', '所属区域').reset_index()
 
         # 创建空figure
         fig_region = go.Figure()
@@ -552,63 +2002,8 @@ with tabs[0]:  # 销售概览
     }
 
 
-    # 修复提取包装类型的函数
-    def extract_packaging(product_name):
-        """
-        提取产品名称中的包装类型，增强错误处理
-        """
-        try:
-            # 确保产品名称是字符串
-            if not isinstance(product_name, str):
-                return "其他"
-
-            # 检查组合类型
-            if '分享装袋装' in product_name:
-                return '分享装袋装'
-            elif '分享装盒装' in product_name:
-                return '分享装盒装'
-
-            # 按包装大小分类（从大到小）
-            elif '随手包' in product_name:
-                return '随手包'
-            elif '迷你包' in product_name:
-                return '迷你包'
-            elif '分享装' in product_name:
-                return '分享装'
-
-            # 按包装形式分类
-            elif '袋装' in product_name:
-                return '袋装'
-            elif '盒装' in product_name:
-                return '盒装'
-
-            # 处理特殊规格
-            elif 'KG' in product_name or 'kg' in product_name:
-                if '1.5KG' in product_name or '1.5kg' in product_name:
-                    return '大包装'
-                elif '2KG' in product_name or '2kg' in product_name:
-                    return '大包装'
-                else:
-                    return '散装'
-            elif 'G' in product_name:
-                match = re.search(r'(\d+)G', product_name)
-                if match:
-                    weight = int(match.group(1))
-                    if weight <= 50:
-                        return '小包装'
-                    elif weight <= 100:
-                        return '中包装'
-                    else:
-                        return '大包装'
-
-            # 默认分类
-            return '其他'
-        except:
-            return '其他'  # 捕获任何异常并返回默认值
-
-
-    filtered_df['包装类型'] = filtered_df['产品名称'].apply(extract_packaging)
-    packaging_sales = filtered_df.groupby('包装类型')['销售额'].sum().reset_index()
+    # 包装类型在加载数据时已计算为分类列，这里只需分组汇总
+    packaging_sales = get_aggregate(aggregate_registry, '全部', '包装类型').reset_index()
 
     col1, col2 = st.columns(2)
 
@@ -658,18 +2053,37 @@ with tabs[0]:  # 销售概览
         st.plotly_chart(fig_packaging, use_container_width=True)
 
     with col2:
-        # 价格-销量散点图
-        fig_price_qty = px.scatter(
-            filtered_df,
-            x='单价（箱）',
-            y='数量（箱）',
-            size='销售额',
-            color='所属区域',
-            hover_name='简化产品名称',  # 使用简化产品名称
-            title='价格与销售数量关系',
-            labels={'单价（箱）': '单价 (元/箱)', '数量（箱）': '销售数量 (箱)'},
-            height=500
-        )
+        # 价格-销量散点图 - 行数较多时改用WebGL渲染，行数很大时改为按区域的二维分箱，保证图表数据量有上限
+        scatter_mode = price_quantity_render_mode(len(filtered_df))
+        if scatter_mode == 'binned':
+            price_qty_bins = get_cached_result(
+                aggregate_registry, ('price_quantity_bins', SCATTER_BINS), lambda: bin_price_quantity(filtered_df)
+            )
+            fig_price_qty = px.scatter(
+                price_qty_bins,
+                x='单价（箱）',
+                y='数量（箱）',
+                size=price_qty_bins['销售额'].clip(lower=0),
+                color='所属区域',
+                hover_data={'行数': True, '销售额': ':,.0f'},
+                title=f'价格与销售数量关系（按{SCATTER_BINS}×{SCATTER_BINS}网格分箱）',
+                labels={'单价（箱）': '单价 (元/箱)', '数量（箱）': '销售数量 (箱)', 'size': '销售额'},
+                render_mode='webgl',
+                height=500
+            )
+        else:
+            fig_price_qty = px.scatter(
+                filtered_df,
+                x='单价（箱）',
+                y='数量（箱）',
+                size='销售额',
+                color='所属区域',
+                hover_name='简化产品名称',  # 使用简化产品名称
+                title='价格与销售数量关系',
+                labels={'单价（箱）': '单价 (元/箱)', '数量（箱）': '销售数量 (箱)'},
+                render_mode=scatter_mode,
+                height=500
+            )
 
         # 修复x轴单位显示
         fig_price_qty.update_xaxes(
@@ -693,7 +2107,7 @@ with tabs[0]:  # 销售概览
 
     # 申请人销售业绩
     st.markdown('<div class="sub-header section-gap"> 👨‍💼 申请人销售业绩</div>', unsafe_allow_html=True)
-    applicant_performance = filtered_df.groupby('申请人')['销售额'].sum().sort_values(ascending=False).reset_index()
+    applicant_performance = get_aggregate(aggregate_registry, '全部', '申请人').sort_values(ascending=False).reset_index()
 
     # 申请人销售业绩 - 使用go.Figure修复标签问题
     fig_applicant = go.Figure()
@@ -741,14 +2155,14 @@ with tabs[0]:  # 销售概览
     with st.expander("查看筛选后的原始数据"):
         st.dataframe(filtered_df)
 
-with tabs[1]:  # 新品分析
+if active_section == '新品分析':
     st.markdown('<div class="sub-header"> 🆕 新品销售分析</div>', unsafe_allow_html=True)
 
     # 新品KPI指标
     col1, col2, col3 = st.columns(3)
 
     with col1:
-        new_products_sales = filtered_new_products_df['销售额'].sum()
+        new_products_sales = get_aggregate(aggregate_registry, '新品')
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">新品销售额</div>
@@ -766,7 +2180,7 @@ with tabs[1]:  # 新品分析
         """, unsafe_allow_html=True)
 
     with col3:
-        new_products_customers = filtered_new_products_df['客户简称'].nunique()
+        new_products_customers = get_aggregate(aggregate_registry, '新品', column='客户简称', func='nunique')
         st.markdown(f"""
         <div class="card">
             <div class="metric-label">购买新品的客户数</div>
@@ -778,8 +2192,9 @@ with tabs[1]:  # 新品分析
     st.markdown('<div class="sub-header section-gap">各新品销售额对比</div>', unsafe_allow_html=True)
 
     if not filtered_new_products_df.empty:
-        # 使用简化产品名称
-        product_sales = filtered_new_products_df.groupby(['产品代码', '简化产品名称'])['销售额'].sum().reset_index()
+        # 使用产品维度表中的简化产品名称
+        product_sales = get_aggregate(aggregate_registry, '新品', '产品代码').reset_index()
+        product_sales['简化产品名称'] = product_sales['产品代码'].astype(str).map(product_name_mapping)
         product_sales = product_sales.sort_values('销售额', ascending=False)
 
         # 使用go.Figure修复标签问题
@@ -830,8 +2245,7 @@ with tabs[1]:  # 新品分析
 
         with col1:
             # 区域新品销售额堆叠柱状图
-            region_product_sales = filtered_new_products_df.groupby(['所属区域', '简化产品名称'])[
-                '销售额'].sum().reset_index()
+            region_product_sales = get_aggregate(aggregate_registry, '新品', ['所属区域', '简化产品名称']).reset_index()
             fig_region_product = px.bar(
                 region_product_sales,
                 x='所属区域',
@@ -883,11 +2297,10 @@ with tabs[1]:  # 新品分析
         st.markdown('<div class="sub-header section-gap">各区域内新品销售占比</div>', unsafe_allow_html=True)
 
         # 计算各区域的新品总销售额
-        region_total_sales = filtered_new_products_df.groupby('所属区域')['销售额'].sum().reset_index()
+        region_total_sales = get_aggregate(aggregate_registry, '新品', '所属区域').reset_index()
 
         # 计算各区域各新品的销售占比
-        region_product_sales = filtered_new_products_df.groupby(['所属区域', '产品代码', '简化产品名称'])[
-            '销售额'].sum().reset_index()
+        region_product_sales = get_aggregate(aggregate_registry, '新品', ['所属区域', '产品代码', '简化产品名称']).reset_index()
         region_product_sales = region_product_sales.merge(region_total_sales, on='所属区域', suffixes=('', '_区域总计'))
         region_product_sales['销售占比'] = region_product_sales['销售额'] / region_product_sales[
             '销售额_区域总计'] * 100
@@ -901,19 +2314,20 @@ with tabs[1]:  # 新品分析
             values='销售占比',
             index='所属区域',
             columns='显示名称',  # 使用简化名称作为列名
-            fill_value=0
+            fill_value=0,
+            observed=True
         )
 
-        # 使用Plotly创建热力图
-        fig_heatmap = px.imshow(
+        # 使用Plotly创建热力图（数值标签作为文本层输出）
+        fig_heatmap, heatmap_truncated = build_heatmap(
             pivot_percentage,
+            texttemplate='%{z:.2f}%',
             labels=dict(x="产品名称", y="区域", color="销售占比 (%)"),
-            x=pivot_percentage.columns,
-            y=pivot_percentage.index,
             color_continuous_scale="YlGnBu",
             title="各区域内新品销售占比 (%)",
             height=500
         )
+        fig_heatmap.update_traces(textfont=dict(size=14))
 
         fig_heatmap.update_layout(
             xaxis_title=dict(text="产品名称", font=dict(size=16)),
@@ -922,17 +2336,8 @@ with tabs[1]:  # 新品分析
             font=dict(size=14)
         )
 
-        # 修改热力图注释代码
-        for i in range(len(pivot_percentage.index)):
-            for j in range(len(pivot_percentage.columns)):
-                fig_heatmap.add_annotation(
-                    x=j,
-                    y=i,
-                    text=f"{pivot_percentage.iloc[i, j]:.2f}%",  # 修改：强制保留2位小数
-                    showarrow=False,
-                    font=dict(color="black" if pivot_percentage.iloc[i, j] < 50 else "white", size=14)
-                )
-
+        if heatmap_truncated:
+            st.caption(f"区域和新品较多，热力图仅展示销售占比合计最高的部分（最多{HEATMAP_MAX_CELLS}个单元格）。")
         st.plotly_chart(fig_heatmap, use_container_width=True)
     else:
         st.warning("当前筛选条件下没有新品数据。请调整筛选条件或确认数据中包含新品。")
@@ -946,31 +2351,14 @@ with tabs[1]:  # 新品分析
         else:
             st.info("当前筛选条件下没有新品数据。")
 
-with tabs[2]:  # 客户细分
+if active_section == '客户细分':
     st.markdown('<div class="sub-header"> 👥 客户细分分析</div>', unsafe_allow_html=True)
 
     if not filtered_df.empty:
-        # 计算客户特征
-        customer_features = filtered_df.groupby('客户简称').agg({
-            '销售额': 'sum',  # 总销售额
-            '产品代码': lambda x: len(set(x)),  # 购买的不同产品数量
-            '数量（箱）': 'sum',  # 总购买数量
-            '单价（箱）': 'mean'  # 平均单价
-        }).reset_index()
-
-        # 添加新品购买指标
-        new_products_by_customer = filtered_new_products_df.groupby('客户简称')['销售额'].sum().reset_index()
-        customer_features = customer_features.merge(new_products_by_customer, on='客户简称', how='left',
-                                                    suffixes=('', '_新品'))
-        customer_features['销售额_新品'] = customer_features['销售额_新品'].fillna(0)
-        customer_features['新品占比'] = customer_features['销售额_新品'] / customer_features['销售额'] * 100
-
-        # 简单客户分类
-        customer_features['客户类型'] = pd.cut(
-            customer_features['新品占比'],
-            bins=[0, 10, 30, 100],
-            labels=['保守型客户', '平衡型客户', '创新型客户']
-        )
+        # 计算客户特征（按筛选状态缓存，切回本模块时直接复用）
+        customer_features = get_cached_result(
+            aggregate_registry, 'customer_features', lambda: compute_customer_features(aggregate_registry)
+        ).copy()
 
         # 添加客户类型解释
         st.markdown('<div class="highlight" style="margin-bottom: 20px;">', unsafe_allow_html=True)
@@ -1036,7 +2424,9 @@ with tabs[2]:  # 客户细分
         # 客户类型特征对比
         st.markdown('<div class="sub-header section-gap">不同客户类型的特征对比</div>', unsafe_allow_html=True)
 
-        # 创建子图 - 优化版
+        # 创建子图 - 优化版（make_subplots只在此处使用，按需导入）
+        from plotly.subplots import make_subplots
+
         fig = make_subplots(rows=1, cols=2,
                             subplot_titles=("客户类型平均销售额", "客户类型平均新品占比"),
                             specs=[[{"type": "bar"}, {"type": "bar"}]])
@@ -1138,6 +2528,7 @@ with tabs[2]:  # 客户细分
             size='产品代码',  # 购买的产品种类数量
             hover_name='客户简称',
             title='客户销售额与新品占比关系',
+            render_mode='webgl' if len(customer_features) > SCATTER_WEBGL_THRESHOLD else 'svg',
             labels={
                 '销售额': '销售额 (元)',
                 '新品占比': '新品销售占比 (%)',
@@ -1167,6 +2558,59 @@ with tabs[2]:  # 客户细分
 
         st.plotly_chart(fig_scatter, use_container_width=True)
 
+        # RFM聚类细分
+        st.markdown('<div class="sub-header section-gap">RFM聚类细分</div>', unsafe_allow_html=True)
+        st.info("按最近购买间隔(R)、活跃月数(F)、销售额(M)等特征对客户做k-means聚类，可自行选择特征和群组数量。")
+
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            segment_features = st.multiselect(
+                "聚类特征",
+                SEGMENT_FEATURES,
+                default=SEGMENT_DEFAULT_FEATURES,
+                format_func=lambda feature: SEGMENT_FEATURE_LABELS.get(feature, feature),
+                key='segment_features'
+            )
+        with col2:
+            segment_count = st.slider("群组数量", min_value=2, max_value=8, value=4, key='segment_count')
+
+        if segment_features and len(customer_features) >= 2:
+            # 聚类结果按筛选状态、特征和群组数量缓存
+            segments, segment_profile = get_cached_result(
+                aggregate_registry, ('customer_segments', tuple(segment_features), segment_count),
+                lambda: segment_customers(customer_features, segment_features, segment_count)
+            )
+            customer_features['聚类群组'] = segments
+
+            fig_segments = px.scatter(
+                customer_features,
+                x='活跃月数',
+                y='销售额',
+                color='聚类群组',
+                hover_name='客户简称',
+                hover_data=['最近购买间隔', '订单行数'],
+                title='客户聚类分布（活跃月数 × 销售额）',
+                labels={'活跃月数': '活跃月数', '销售额': '销售额 (元)'},
+                render_mode='webgl' if len(customer_features) > SCATTER_WEBGL_THRESHOLD else 'svg',
+                category_orders={'聚类群组': list(segments.cat.categories)},
+                height=500
+            )
+            fig_segments.update_layout(
+                xaxis_title=dict(text="活跃月数", font=dict(size=16)),
+                yaxis_title=dict(text="销售额 (元)", font=dict(size=16)),
+                xaxis_tickfont=dict(size=14),
+                yaxis_tickfont=dict(size=14),
+                margin=dict(t=60, b=80, l=80, r=60),
+                plot_bgcolor='rgba(0,0,0,0)',
+                legend_font=dict(size=14)
+            )
+            fig_segments.update_yaxes(tickformat=',')
+            st.plotly_chart(fig_segments, use_container_width=True)
+
+            st.dataframe(segment_profile, hide_index=True, use_container_width=True)
+        else:
+            st.warning("请至少选择一个聚类特征，且当前筛选条件下至少需要两个客户。")
+
         # 新品接受度最高的客户
         st.markdown('<div class="sub-header section-gap">新品接受度最高的客户</div>', unsafe_allow_html=True)
 
@@ -1231,7 +2675,7 @@ with tabs[2]:  # 客户细分
     else:
         st.warning("当前筛选条件下没有客户数据。请调整筛选条件。")
 
-with tabs[3]:  # 产品组合
+if active_section == '产品组合':
     st.markdown('<div class="sub-header"> 🔄 产品组合分析</div>', unsafe_allow_html=True)
 
     if not filtered_df.empty and len(filtered_df['客户简称'].unique()) > 1 and len(
@@ -1240,46 +2684,29 @@ with tabs[3]:  # 产品组合
         st.markdown('<div class="sub-header section-gap">产品共现矩阵分析</div>', unsafe_allow_html=True)
         st.info("共现矩阵显示不同产品一起被同一客户购买的频率，有助于发现产品间的关联。")
 
-        # 准备数据 - 创建交易矩阵
-        transaction_data = filtered_df.groupby(['客户简称', '产品代码'])['销售额'].sum().unstack().fillna(0)
-        # 转换为二进制格式（是否购买）
-        transaction_binary = transaction_data.applymap(lambda x: 1 if x > 0 else 0)
-
-        # 创建产品共现矩阵
-        co_occurrence = pd.DataFrame(0, index=transaction_binary.columns, columns=transaction_binary.columns)
-
-        # 创建产品代码到简化名称的映射
-        name_mapping = {code: df[df['产品代码'] == code]['简化产品名称'].iloc[0]
-        if len(df[df['产品代码'] == code]) > 0 else code
-                        for code in transaction_binary.columns}
-
-        # 计算共现次数
-        for _, row in transaction_binary.iterrows():
-            bought_products = row.index[row == 1].tolist()
-            for p1 in bought_products:
-                for p2 in bought_products:
-                    if p1 != p2:
-                        co_occurrence.loc[p1, p2] += 1
+        # 准备数据 - 由客户×产品销售额汇总构建关联矩阵，共现矩阵通过一次矩阵乘法得到
+        co_occurrence = get_cached_result(
+            aggregate_registry, 'co_occurrence',
+            lambda: build_co_occurrence(get_aggregate(aggregate_registry, '全部', ['客户简称', '产品代码']))
+        )
 
         # 筛选新品的共现情况
-        new_product_co_occurrence = pd.DataFrame()
-        valid_new_products = [p for p in new_products if p in co_occurrence.index]
+        valid_new_products = [p for p in new_products if p in co_occurrence['products']]
 
         if valid_new_products:
-            for np_code in valid_new_products:
-                top_co = co_occurrence.loc[np_code].sort_values(ascending=False).head(5)
-                new_product_co_occurrence[np_code] = top_co
-
             # 可视化每个新品的前5个共现产品
             for np_code in valid_new_products:
-                np_name = name_mapping.get(np_code, np_code)  # 获取新品的简化名称
+                np_name = product_name_mapping.get(np_code, np_code)  # 获取新品的简化名称
                 st.markdown(f'<div class="sub-header">与"{np_name}"共同购买最多的产品</div>', unsafe_allow_html=True)
 
-                co_data = co_occurrence.loc[np_code].sort_values(ascending=False).head(5).reset_index()
+                co_data = co_occurrence_top_k(co_occurrence, np_code).reset_index()
+                if co_data.empty:
+                    st.info(f"当前筛选条件下没有客户同时购买{np_name}和其他产品。")
+                    continue
                 co_data.columns = ['产品代码', '共现次数']
 
                 # 添加简化产品名称
-                co_data['简化产品名称'] = co_data['产品代码'].map(name_mapping)
+                co_data['简化产品名称'] = co_data['产品代码'].map(product_name_mapping)
 
                 # 使用go.Figure修复标签问题 - 共现产品图
                 fig_co = go.Figure()
@@ -1326,35 +2753,31 @@ with tabs[3]:  # 产品组合
             st.info("热力图显示产品之间的共现关系，颜色越深表示两个产品一起购买的频率越高。")
 
             # 筛选主要产品以避免图表过于复杂
-            top_products = filtered_df.groupby('产品代码')['销售额'].sum().sort_values(ascending=False).head(
-                10).index.tolist()
+            # 与导出报告的产品销售汇总共用同一聚合结果
+            top_products = [code for code in get_aggregate(aggregate_registry, '全部', '产品代码').sort_values(
+                ascending=False).index.astype(str) if code in co_occurrence['products']][:10]
             # 确保所有新品都包含在内
-            for np in valid_new_products:
-                if np not in top_products:
-                    top_products.append(np)
-
-            # 创建简化名称映射的列表
-            top_product_names = [name_mapping.get(code, code) for code in top_products]
+            for np_code in valid_new_products:
+                if np_code not in top_products:
+                    top_products.append(np_code)
 
             # 创建热力图数据
-            heatmap_data = co_occurrence.loc[top_products, top_products].copy()
+            heatmap_data = co_occurrence_submatrix(co_occurrence, top_products)
 
-            # 修改共现热力图创建代码
-            fig_co_heatmap = px.imshow(
+            # 共现热力图：数值标签作为文本层输出，零值不显示；产品过多时优先保留新品
+            fig_co_heatmap, co_heatmap_truncated = build_heatmap(
                 heatmap_data,
+                texttemplate='%{text}',
+                hide_zero=True,
+                pinned=valid_new_products,
+                x=product_name_mapping,
+                y=product_name_mapping,
                 labels=dict(x="产品名称", y="产品名称", color="共现次数"),
-                x=top_product_names,
-                y=top_product_names,
                 color_continuous_scale="Viridis",
                 title="产品共现热力图",
                 height=650  # 增加高度
             )
-
-            fig_co_heatmap.update_layout(
-                margin=dict(t=80, b=80, l=100, r=100),
-                font=dict(size=14),
-                xaxis_tickangle=-45  # 倾斜x轴标签以防重叠
-            )
+            fig_co_heatmap.update_traces(textfont=dict(size=12))
 
             # 更新热力图布局 - 增加边距并调整标签角度
             fig_co_heatmap.update_layout(
@@ -1371,44 +2794,69 @@ with tabs[3]:  # 产品组合
                 )
             )
 
-            # 修改热力图标注字体大小
-            for i in range(len(top_products)):
-                for j in range(len(top_products)):
-                    if heatmap_data.iloc[i, j] > 0:  # 只显示非零值
-                        fig_co_heatmap.add_annotation(
-                            x=j,
-                            y=i,
-                            text=f"{int(heatmap_data.iloc[i, j])}",
-                            showarrow=False,
-                            font=dict(
-                                color="white" if heatmap_data.iloc[i, j] > heatmap_data.max().max() / 2 else "black",
-                                size=11  # 减小标注字体大小
-                            )
-                        )
-
-            # 添加数值注释 - 修复显示准确性
-            for i in range(len(top_products)):
-                for j in range(len(top_products)):
-                    if heatmap_data.iloc[i, j] > 0:  # 只显示非零值
-                        fig_co_heatmap.add_annotation(
-                            x=j,
-                            y=i,
-                            text=f"{int(heatmap_data.iloc[i, j])}",  # 使用整数显示
-                            showarrow=False,
-                            font=dict(
-                                color="white" if heatmap_data.iloc[i, j] > heatmap_data.max().max() / 2 else "black",
-                                size=12)
-                        )
-
+            if co_heatmap_truncated:
+                st.caption(f"产品较多，热力图仅展示共现次数最高的部分产品（最多{HEATMAP_MAX_CELLS}个单元格，新品优先）。")
             st.plotly_chart(fig_co_heatmap, use_container_width=True)
         else:
             st.warning("在当前筛选条件下，未找到新品数据或共现关系。")
 
+        # 关联规则分析
+        st.markdown('<div class="sub-header section-gap">关联规则分析</div>', unsafe_allow_html=True)
+        st.info("支持度：同时购买前项和后项的交易占比；置信度：购买前项的交易中同时购买后项的比例；"
+                "提升度：置信度与后项整体购买率之比，大于1表示前项对后项有促进作用。")
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            rule_granularity = st.radio("交易粒度", ['客户', '客户-月份'], horizontal=True, key='rule_granularity')
+        with col2:
+            rule_min_support = st.slider("最小支持度", min_value=0.01, max_value=0.5,
+                                         value=ASSOCIATION_MIN_SUPPORT, step=0.01, key='rule_min_support')
+        with col3:
+            rule_min_confidence = st.slider("最小置信度", min_value=0.0, max_value=1.0,
+                                            value=ASSOCIATION_MIN_CONFIDENCE, step=0.05, key='rule_min_confidence')
+        rules_new_only = st.checkbox("只显示涉及新品的规则", value=True, key='rules_new_only')
+
+        # 频繁项集和规则按筛选状态、交易粒度和最小支持度缓存，调整置信度或新品选项时直接复用
+        if rule_granularity == '客户':
+            rule_transactions = co_occurrence
+        else:
+            rule_transactions = get_cached_result(
+                aggregate_registry, ('co_occurrence', rule_granularity),
+                lambda: build_co_occurrence(transaction_product_sales(filtered_cube, rule_granularity))
+            )
+        association_rules = get_cached_result(
+            aggregate_registry, ('association_rules', rule_granularity, rule_min_support),
+            lambda: mine_association_rules(rule_transactions, rule_min_support)
+        )
+
+        display_rules = association_rules[association_rules['置信度'] >= rule_min_confidence]
+        if rules_new_only:
+            new_product_set = set(new_products)
+            involves_new = [bool(new_product_set.intersection(antecedent)) or consequent in new_product_set
+                            for antecedent, consequent in zip(display_rules['前项'], display_rules['后项'])]
+            display_rules = display_rules[involves_new]
+
+        if not display_rules.empty:
+            display_rules = display_rules.assign(
+                前项=['、'.join(product_name_mapping.get(code, code) for code in antecedent)
+                    for antecedent in display_rules['前项']],
+                后项=[product_name_mapping.get(code, code) for code in display_rules['后项']]
+            )
+            st.caption(f"共{len(display_rules)}条规则（{rule_granularity}粒度，"
+                       f"{len(rule_transactions['customers'])}笔交易），按提升度排序。")
+            st.dataframe(
+                display_rules.round({'支持度': 4, '置信度': 4, '提升度': 2}).head(200),
+                hide_index=True,
+                use_container_width=True
+            )
+        else:
+            st.warning("当前条件下没有满足最小支持度和置信度的规则。可以降低最小支持度或最小置信度。")
+
         # 产品购买模式
         st.markdown('<div class="sub-header section-gap">产品购买模式分析</div>', unsafe_allow_html=True)
 
         # 计算平均每单购买的产品种类数
-        avg_products_per_order = transaction_binary.sum(axis=1).mean()
+        avg_products_per_order = co_occurrence['products_per_customer'].mean()
 
         col1, col2 = st.columns(2)
 
@@ -1422,9 +2870,8 @@ with tabs[3]:  # 产品组合
 
         with col2:
             # 计算含有新品的订单比例
-            orders_with_new_products = transaction_binary[valid_new_products].any(
-                axis=1).sum() if valid_new_products else 0
-            total_orders = len(transaction_binary)
+            orders_with_new_products = count_customers_with_products(co_occurrence, valid_new_products)
+            total_orders = len(co_occurrence['customers'])
             percentage_orders_with_new = (orders_with_new_products / total_orders * 100) if total_orders > 0 else 0
 
             st.markdown(f"""
@@ -1435,7 +2882,7 @@ with tabs[3]:  # 产品组合
             """, unsafe_allow_html=True)
 
         # 购买产品种类数分布
-        products_per_order = transaction_binary.sum(axis=1).value_counts().sort_index().reset_index()
+        products_per_order = pd.Series(co_occurrence['products_per_customer']).value_counts().sort_index().reset_index()
         products_per_order.columns = ['产品种类数', '客户数']
 
         # 使用go.Figure修复标签问题 - 购买产品种类数分布
@@ -1477,21 +2924,46 @@ with tabs[3]:  # 产品组合
 
         # 产品组合表格
         with st.expander("查看产品共现矩阵"):
+            # 产品较多时只展示销售额最高的部分产品，避免生成整张大矩阵
+            display_products = [code for code in get_aggregate(aggregate_registry, '全部', '产品代码').sort_values(
+                ascending=False).index.astype(str) if code in co_occurrence['products']][:CO_OCCURRENCE_TABLE_MAX_PRODUCTS]
+            if len(co_occurrence['products']) > len(display_products):
+                st.caption(f"共{len(co_occurrence['products'])}个产品，仅展示销售额最高的{len(display_products)}个。")
             # 转换产品代码为简化名称
-            display_co_occurrence = co_occurrence.copy()
-            display_co_occurrence.index = [name_mapping.get(code, code) for code in display_co_occurrence.index]
-            display_co_occurrence.columns = [name_mapping.get(code, code) for code in display_co_occurrence.columns]
+            display_co_occurrence = co_occurrence_submatrix(co_occurrence, display_products)
+            display_co_occurrence.index = [product_name_mapping.get(code, code) for code in display_co_occurrence.index]
+            display_co_occurrence.columns = [product_name_mapping.get(code, code) for code in display_co_occurrence.columns]
             st.dataframe(display_co_occurrence)
     else:
         st.warning("当前筛选条件下的数据不足以进行产品组合分析。请确保有多个客户和产品。")
 
-with tabs[4]:  # 市场渗透率
+if active_section == '市场渗透率':
     st.markdown('<div class="sub-header"> 🌐 新品市场渗透率分析</div>', unsafe_allow_html=True)
 
     if not filtered_df.empty:
+        # 客户去重方式：近似模式合并 区域×月份×产品 的HyperLogLog草图，草图不含客户和申请人维度，
+        # 按这两个维度筛选时仍使用精确计数
+        count_mode = st.radio("客户数统计方式", ['精确计数', '近似计数（HyperLogLog）'],
+                              horizontal=True, key='penetration_count_mode')
+        customer_sketches = None
+        if count_mode != '精确计数':
+            if selected_customers or selected_applicants:
+                st.caption("按客户或申请人筛选时草图无法拆分，已使用精确计数。")
+            else:
+                customer_sketches = build_customer_sketches(dataset_version, monthly_rollup)
+                st.caption(f"客户数为HyperLogLog估算值（精度p={HLL_PRECISION}），"
+                           f"相对标准误差约{1.04 / np.sqrt(1 << HLL_PRECISION) * 100:.2f}%，"
+                           f"草图占用{customer_sketches['nbytes'] / 1024 ** 2:.2f}MB。")
+
         # 计算总体渗透率
-        total_customers = filtered_df['客户简称'].nunique()
-        new_product_customers = filtered_new_products_df['客户简称'].nunique()
+        if customer_sketches is None:
+            total_customers = get_aggregate(aggregate_registry, '全部', column='客户简称', func='nunique')
+            new_product_customers = get_aggregate(aggregate_registry, '新品', column='客户简称', func='nunique')
+        else:
+            total_customers = query_customer_sketches(customer_sketches, filter_selections)
+            new_product_customers = query_customer_sketches(
+                customer_sketches, filter_selections, new_only=True
+            )
         penetration_rate = (new_product_customers / total_customers * 100) if total_customers > 0 else 0
 
         # KPI指标
@@ -1526,10 +2998,18 @@ with tabs[4]:  # 市场渗透率
 
         if 'selected_regions' in locals() and selected_regions:
             # 按区域计算渗透率
-            region_customers = filtered_df.groupby('所属区域')['客户简称'].nunique().reset_index()
+            if customer_sketches is None:
+                region_customers = get_aggregate(aggregate_registry, '全部', '所属区域', '客户简称', 'nunique')
+                new_region_customers = get_aggregate(aggregate_registry, '新品', '所属区域', '客户简称', 'nunique')
+            else:
+                region_customers = query_customer_sketches(customer_sketches, filter_selections, by='所属区域')
+                new_region_customers = query_customer_sketches(
+                    customer_sketches, filter_selections, by='所属区域', new_only=True
+                )
+            region_customers = region_customers.reset_index()
             region_customers.columns = ['所属区域', '客户总数']
 
-            new_region_customers = filtered_new_products_df.groupby('所属区域')['客户简称'].nunique().reset_index()
+            new_region_customers = new_region_customers.reset_index()
             new_region_customers.columns = ['所属区域', '购买新品客户数']
 
             region_penetration = region_customers.merge(new_region_customers, on='所属区域', how='left')
@@ -1583,7 +3063,7 @@ with tabs[4]:  # 市场渗透率
             st.markdown('<div class="sub-header section-gap">渗透率与销售额的关系</div>', unsafe_allow_html=True)
 
             # 计算每个区域的新品销售额
-            region_new_sales = filtered_new_products_df.groupby('所属区域')['销售额'].sum().reset_index()
+            region_new_sales = get_aggregate(aggregate_registry, '新品', '所属区域').reset_index()
             region_new_sales.columns = ['所属区域', '新品销售额']
 
             # 合并渗透率和销售额数据
@@ -1652,25 +3132,13 @@ with tabs[4]:  # 市场渗透率
             st.markdown('<div class="sub-header section-gap">新品渗透率趋势</div>', unsafe_allow_html=True)
 
             try:
-                # 确保发运月份是日期类型
-                filtered_df['发运月份'] = pd.to_datetime(filtered_df['发运月份'])
-                filtered_new_products_df['发运月份'] = pd.to_datetime(filtered_new_products_df['发运月份'])
-
-                # 按月分组
-                monthly_customers = filtered_df.groupby(pd.Grouper(key='发运月份', freq='M'))[
-                    '客户简称'].nunique().reset_index()
-                monthly_customers.columns = ['月份', '客户总数']
-
-                monthly_new_customers = filtered_new_products_df.groupby(pd.Grouper(key='发运月份', freq='M'))[
-                    '客户简称'].nunique().reset_index()
-                monthly_new_customers.columns = ['月份', '购买新品客户数']
-
-                # 合并月度数据
-                monthly_penetration = monthly_customers.merge(monthly_new_customers, on='月份', how='left')
-                monthly_penetration['购买新品客户数'] = monthly_penetration['购买新品客户数'].fillna(0)
-                monthly_penetration['渗透率'] = (
-                        monthly_penetration['购买新品客户数'] / monthly_penetration['客户总数'] * 100).round(2)
-                monthly_penetration['月份_str'] = monthly_penetration['月份'].dt.strftime('%Y-%m')
+                # 月度渗透率（按筛选状态缓存，切回本模块时直接复用）
+                monthly_penetration = get_cached_result(
+                    aggregate_registry, ('monthly_penetration', customer_sketches is not None),
+                    lambda: compute_monthly_penetration(
+                        monthly_rollup, filter_selections, customer_sketches
+                    )
+                )
 
                 # 创建趋势线图
                 fig_trend = px.line(
@@ -1703,63 +3171,273 @@ with tabs[4]:  # 市场渗透率
     else:
         st.warning("当前筛选条件下没有数据。请调整筛选条件。")
 
+if active_section == '销售趋势':
+    st.markdown('<div class="sub-header"> 📈 销售趋势分析</div>', unsafe_allow_html=True)
+
+    period_labels = {'月度': 'M', '季度': 'Q', '年度': 'Y'}
+    period_name = st.radio("统计周期", list(period_labels), horizontal=True, key='trend_period')
+    period_freq = period_labels[period_name]
+
+    # 各周期汇总直接从月度汇总存储查询（按筛选状态和周期缓存）
+    period_series = get_cached_result(
+        aggregate_registry, ('period_series', period_freq),
+        lambda: add_period_growth(query_monthly_rollup(monthly_rollup, filter_selections, period_freq), period_freq)
+    ).copy()
+
+    if len(period_series) > 0:
+        period_series['周期_str'] = period_series['周期'].astype(str)
+        latest = period_series.iloc[-1]
+
+        # KPI指标
+        col1, col2, col3 = st.columns(3)
+
+        with col1:
+            st.markdown(f"""
+            <div class="card">
+                <div class="metric-label">最近{period_name}销售额（{latest['周期_str']}）</div>
+                <div class="metric-value">{format_yuan(latest['销售额'])}</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+        with col2:
+            mom_text = f"{latest['环比增长率']:.2f}%" if pd.notna(latest['环比增长率']) else "—"
+            st.markdown(f"""
+            <div class="card">
+                <div class="metric-label">环比增长率</div>
+                <div class="metric-value">{mom_text}</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+        with col3:
+            yoy_text = f"{latest['同比增长率']:.2f}%" if pd.notna(latest['同比增长率']) else "—"
+            st.markdown(f"""
+            <div class="card">
+                <div class="metric-label">同比增长率</div>
+                <div class="metric-value">{yoy_text}</div>
+            </div>
+            """, unsafe_allow_html=True)
+
+        # 销售额与环比增长率
+        st.markdown(f'<div class="sub-header section-gap">{period_name}销售额与环比增长</div>', unsafe_allow_html=True)
+        from plotly.subplots import make_subplots
+        fig_growth = make_subplots(specs=[[{"secondary_y": True}]])
+        fig_growth.add_trace(go.Bar(
+            x=period_series['周期_str'],
+            y=period_series['销售额'],
+            name='销售额',
+            marker_color='#1E88E5',
+            text=[format_yuan(value) for value in period_series['销售额']],
+            textposition='outside',
+            textfont=dict(size=12)
+        ), secondary_y=False)
+        fig_growth.add_trace(go.Scatter(
+            x=period_series['周期_str'],
+            y=period_series['环比增长率'],
+            name='环比增长率 (%)',
+            mode='lines+markers',
+            marker_color='#FF7043'
+        ), secondary_y=True)
+        fig_growth.update_layout(
+            title=f'{period_name}销售额与环比增长率',
+            xaxis_title=dict(text="周期", font=dict(size=16)),
+            xaxis_tickfont=dict(size=14),
+            margin=dict(t=60, b=80, l=80, r=60),
+            plot_bgcolor='rgba(0,0,0,0)',
+            height=500
+        )
+        fig_growth.update_yaxes(title_text="销售额 (元)", tickformat=',', secondary_y=False)
+        fig_growth.update_yaxes(title_text="环比增长率 (%)", secondary_y=True)
+        st.plotly_chart(fig_growth, use_container_width=True)
+
+        # 同比增长率
+        st.markdown('<div class="sub-header section-gap">同比增长</div>', unsafe_allow_html=True)
+        if period_series['同比增长率'].notna().any():
+            fig_yoy = px.line(
+                period_series,
+                x='周期_str',
+                y='同比增长率',
+                markers=True,
+                title=f'{period_name}销售额同比增长率',
+                labels={'周期_str': '周期', '同比增长率': '同比增长率 (%)'},
+                height=450
+            )
+            fig_yoy.update_layout(
+                xaxis_title=dict(text="周期", font=dict(size=16)),
+                yaxis_title=dict(text="同比增长率 (%)", font=dict(size=16)),
+                margin=dict(t=60, b=80, l=80, r=60),
+                plot_bgcolor='rgba(0,0,0,0)'
+            )
+            st.plotly_chart(fig_yoy, use_container_width=True)
+        else:
+            st.info("数据跨度不足一年，暂无法计算同比增长率。")
+
+        # 区域本期与上期对比
+        if len(period_series) > 1:
+            current_period, previous_period = period_series['周期'].iloc[-1], period_series['周期'].iloc[-2]
+            st.markdown(f'<div class="sub-header section-gap">各区域{current_period}与{previous_period}对比</div>',
+                        unsafe_allow_html=True)
+
+            region_periods = get_cached_result(
+                aggregate_registry, ('period_series_by_region', period_freq),
+                lambda: query_monthly_rollup(monthly_rollup, filter_selections, period_freq, by='所属区域')
+            )
+            comparison = region_periods[region_periods['周期'].isin([previous_period, current_period])].pivot_table(
+                index='所属区域', columns='周期', values=['销售额', '客户数'], fill_value=0
+            )
+            region_comparison = pd.DataFrame({
+                '所属区域': comparison.index,
+                '上期销售额': comparison['销售额'].get(previous_period, 0),
+                '本期销售额': comparison['销售额'].get(current_period, 0),
+                '上期客户数': comparison['客户数'].get(previous_period, 0),
+                '本期客户数': comparison['客户数'].get(current_period, 0)
+            }).reset_index(drop=True)
+            previous_sales = region_comparison['上期销售额']
+            region_comparison['销售额变化率'] = ((region_comparison['本期销售额'] - previous_sales) /
+                                          previous_sales.where(previous_sales != 0) * 100).round(2)
+
+            fig_period_compare = go.Figure()
+            fig_period_compare.add_trace(go.Bar(
+                x=region_comparison['所属区域'], y=region_comparison['上期销售额'], name=str(previous_period),
+                marker_color='#90CAF9'
+            ))
+            fig_period_compare.add_trace(go.Bar(
+                x=region_comparison['所属区域'], y=region_comparison['本期销售额'], name=str(current_period),
+                marker_color='#1E88E5'
+            ))
+            fig_period_compare.update_layout(
+                title=f'各区域销售额：{current_period} vs {previous_period}',
+                xaxis_title=dict(text="区域", font=dict(size=16)),
+                yaxis_title=dict(text="销售额 (元)", font=dict(size=16)),
+                xaxis_tickfont=dict(size=14),
+                yaxis_tickfont=dict(size=14),
+                margin=dict(t=60, b=80, l=80, r=60),
+                plot_bgcolor='rgba(0,0,0,0)',
+                barmode='group',
+                height=500
+            )
+            fig_period_compare.update_yaxes(tickformat=',')
+            st.plotly_chart(fig_period_compare, use_container_width=True)
+
+            with st.expander("查看区域对比明细"):
+                st.dataframe(region_comparison, hide_index=True)
+
+        with st.expander(f"查看{period_name}汇总数据"):
+            st.dataframe(period_series.drop(columns=['周期']).set_index('周期_str'))
+    else:
+        st.warning("当前筛选条件下没有可用的发运月份数据。请调整筛选条件或确认发运月份格式正确。")
+
+
 # 底部下载区域
 st.markdown("---")
 st.markdown('<div class="sub-header"> 📊 导出分析结果</div>', unsafe_allow_html=True)
 
 
+# Excel报告每次写入的行数（constant_memory模式下按行顺序写出，已写出的行不再占用内存）
+EXCEL_REPORT_CHUNK_ROWS = 10000
+
+
+# 把数据表按块逐行写入工作表
+def _write_report_sheet(workbook, sheet_name, df, chunk_rows=EXCEL_REPORT_CHUNK_ROWS):
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].astype(object)
+        rows = chunk.where(chunk.notna(), None).to_numpy()
+        for offset, row in enumerate(rows, start=start + 1):
+            worksheet.write_row(offset, 0, row)
+
+
 # 创建Excel报告
-@st.cache_data
-def generate_excel_report(df, new_products_df):
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-
-    # 销售概览表
-    df.to_excel(writer, sheet_name='销售数据总览', index=False)
-
-    # 新品分析表
-    new_products_df.to_excel(writer, sheet_name='新品销售数据', index=False)
-
-    # 区域销售汇总
-    region_summary = df.groupby('所属区域').agg({
-        '销售额': 'sum',
-        '客户简称': pd.Series.nunique,
-        '产品代码': pd.Series.nunique,
-        '数量（箱）': 'sum'
-    }).reset_index()
-    region_summary.columns = ['区域', '销售额', '客户数', '产品数', '销售数量']
-    region_summary.to_excel(writer, sheet_name='区域销售汇总', index=False)
-
-    # 产品销售汇总
-    product_summary = df.groupby(['产品代码', '简化产品名称']).agg({
-        '销售额': 'sum',
-        '客户简称': pd.Series.nunique,
-        '数量（箱）': 'sum'
-    }).sort_values('销售额', ascending=False).reset_index()
-    product_summary.columns = ['产品代码', '产品名称', '销售额', '购买客户数', '销售数量']
-    product_summary.to_excel(writer, sheet_name='产品销售汇总', index=False)
-
-    # 保存Excel
-    writer.close()
-
-    return output.getvalue()
-
-
-excel_report = generate_excel_report(filtered_df, filtered_new_products_df)
-
-# 下载按钮
-st.markdown('<div class="download-button">', unsafe_allow_html=True)
-st.download_button(
-    label="下载Excel分析报告",
-    data=excel_report,
-    file_name="销售数据分析报告.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-)
-st.markdown('</div>', unsafe_allow_html=True)
+@st.cache_data(max_entries=8)
+def generate_excel_report(report_key, _df, _new_products_df, _region_summary, _product_summary):
+    """
+    report_key 为 (数据集版本, 筛选状态)，报告只按该键缓存，不对数据表做哈希。
+    使用xlsxwriter的constant_memory模式写入临时文件，数据按块逐行写出，避免在内存中构建整个工作簿
+    """
+    xlsxwriter = importlib.import_module('xlsxwriter')
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+        _write_report_sheet(workbook, '销售数据总览', _df)
+        _write_report_sheet(workbook, '新品销售数据', _new_products_df)
+        _write_report_sheet(workbook, '区域销售汇总', _region_summary)
+        _write_report_sheet(workbook, '产品销售汇总', _product_summary)
+        workbook.close()
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+# 构建导出用的汇总表
+def build_report_summaries(registry):
+    """导出用的区域/产品汇总表，与各分析模块共用聚合登记表中的结果"""
+    region_summary = get_aggregate_table(registry, '全部', '所属区域', [
+        ('销售额', '销售额', 'sum'),
+        ('客户数', '客户简称', 'nunique'),
+        ('产品数', '产品代码', 'nunique'),
+        ('销售数量', '数量（箱）', 'sum')
+    ]).rename(columns={'所属区域': '区域'})
+    product_summary = get_aggregate_table(registry, '全部', '产品代码', [
+        ('销售额', '销售额', 'sum'),
+        ('购买客户数', '客户简称', 'nunique'),
+        ('销售数量', '数量（箱）', 'sum')
+    ]).sort_values('销售额', ascending=False)
+    # 产品属性从产品维度表关联
+    product_summary['产品代码'] = product_summary['产品代码'].astype(str)
+    product_summary = product_summary.merge(
+        product_dimension.rename(columns={'简化产品名称': '产品名称'}), left_on='产品代码', right_index=True, how='left'
+    )[['产品代码', '产品名称', '包装类型', '规格重量', '是否新品', '销售额', '购买客户数', '销售数量']]
+    return region_summary, product_summary
+
+
+# 报告只在点击生成按钮后才创建，同一数据集版本和筛选状态下直接复用已生成的报告
+report_key = aggregate_registry['scope']
+if st.button("生成Excel分析报告"):
+    st.session_state['excel_report_key'] = report_key
+
+if st.session_state.get('excel_report_key') == report_key:
+    with st.spinner("正在生成Excel分析报告..."):
+        region_summary, product_summary = build_report_summaries(aggregate_registry)
+        excel_report = generate_excel_report(
+            report_key, filtered_df, filtered_new_products_df, region_summary, product_summary
+        )
+
+    # 下载按钮
+    st.markdown('<div class="download-button">', unsafe_allow_html=True)
+    st.download_button(
+        label="下载Excel分析报告",
+        data=excel_report,
+        file_name="销售数据分析报告.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+    st.markdown('</div>', unsafe_allow_html=True)
+else:
+    st.caption("点击按钮生成当前筛选条件下的Excel分析报告。")
 
 # 底部注释
 st.markdown("""
 <div style="text-align: center; margin-top: 30px; color: #666;">
     <p>销售数据分析仪表盘 © 2025</p>
 </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+# 启动耗时报告
+_record_startup_timing('脚本总耗时', _SCRIPT_START)
+import_time_ms = startup_timings[0][1]
+with st.sidebar.expander("启动耗时报告"):
+    st.dataframe(
+        pd.DataFrame(startup_timings, columns=['阶段', '耗时(毫秒)']).round(1),
+        hide_index=True,
+        use_container_width=True
+    )
+    result_cache = aggregate_registry['cache']
+    lookups = result_cache['hits'] + result_cache['misses']
+    st.caption(
+        f"结果缓存：命中率{(result_cache['hits'] / lookups * 100 if lookups else 0):.1f}%"
+        f"（命中{result_cache['hits']}次，未命中{result_cache['misses']}次），"
+        f"缓存{len(result_cache['entries'])}个筛选组合，约{result_cache['total_bytes'] / 1024 ** 2:.2f}MB"
+    )
+    if import_time_ms > IMPORT_TIME_BUDGET_MS:
+        st.warning(f"基础库导入耗时{import_time_ms:.0f}毫秒，超出预算{IMPORT_TIME_BUDGET_MS}毫秒。")
@@ -0,0 +1,480 @@
+"""
+销售工作簿的解析与预处理：表头预检、流式读取、列式缓存和多进程并行解析。
+本模块不调用界面函数，进程池以spawn方式启动子进程，子进程只需导入本模块
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+# 数据文件必须包含的列
+REQUIRED_COLUMNS = ['客户简称', '所属区域', '发运月份', '申请人', '产品代码', '产品名称',
+                    '订单类型', '单价（箱）', '数量（箱）']
+
+# 常见的列名别名（匹配前会统一全角/半角字符并去除空白，如"单价(箱)"可直接匹配"单价（箱）"）
+COLUMN_ALIASES = {
+    '客户': '客户简称',
+    '客户名称': '客户简称',
+    '区域': '所属区域',
+    '发货月份': '发运月份',
+    '月份': '发运月份',
+    '单价': '单价（箱）',
+    '数量': '数量（箱）',
+    '箱数': '数量（箱）'
+}
+
+# 列式缓存目录与版本号（预处理逻辑变化时递增版本号，使旧缓存自动失效）
+COLUMNAR_CACHE_DIR = os.path.join(".cache", "columnar")
+COLUMNAR_CACHE_VERSION = 2
+
+# 超过该大小的xlsx文件使用只读流式解析，每块读取的行数
+STREAMING_THRESHOLD_BYTES = 20 * 1024 * 1024
+STREAMING_CHUNK_ROWS = 50000
+
+
+# 数据预处理函数
+def preprocess_sales_data(df):
+    """
+    对原始销售数据进行预处理：计算销售额、转换日期、统一字符串列并添加简化产品名称。
+    不影响加载的问题（如日期格式无法转换）记录在attrs['parse_warnings']中，由界面负责显示
+    """
+    # 计算销售额
+    df['销售额'] = df['单价（箱）'] * df['数量（箱）']
+
+    # 确保发运月份是日期类型
+    try:
+        df['发运月份'] = pd.to_datetime(df['发运月份'])
+    except Exception as e:
+        df.attrs.setdefault('parse_warnings', []).append(f"转换日期格式时出错: {str(e)}。月份分析功能可能受影响。")
+
+    # 确保所有的字符串列都是字符串类型
+    for col in ['客户简称', '所属区域', '申请人', '产品代码', '产品名称', '订单类型']:
+        df[col] = df[col].astype(str)
+
+    # 添加简化产品名称列
+    df['简化产品名称'] = simplify_product_names(df)
+
+    # 添加包装类型列（产品属性，加载时计算一次）
+    df['包装类型'] = classify_packaging(df['产品名称'])
+
+    return df
+
+
+# 流式读取大型Excel文件
+def read_excel_streaming(file_path, sheet_name=None, column_mapping=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    """
+    使用openpyxl只读模式逐行读取工作表（默认第一个），只保留必需列，按块构建DataFrame并逐块预处理，
+    峰值内存由块大小决定而不是工作簿大小。column_mapping为{原列名: 标准列名}
+    """
+    from openpyxl import load_workbook
+
+    column_mapping = column_mapping or {}
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet_name] if sheet_name is not None else workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None) or ()
+
+        # 记录必需列在表头中的位置（重复列名取第一次出现的位置，与pd.read_excel一致）
+        positions = {}
+        for idx, name in enumerate(header):
+            name = column_mapping.get(name, name)
+            if name in REQUIRED_COLUMNS and name not in positions:
+                positions[name] = idx
+
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in positions]
+        if missing_columns:
+            raise ValueError(f"文件缺少必要的列: {', '.join(missing_columns)}")
+
+        column_positions = [positions[col] for col in REQUIRED_COLUMNS]
+        chunks = []
+        records = []
+        for row in rows:
+            record = tuple(row[idx] if idx < len(row) else None for idx in column_positions)
+            # 跳过空行
+            if all(value is None for value in record):
+                continue
+            records.append(record)
+            if len(records) >= chunk_rows:
+                chunks.append(_preprocess_streaming_chunk(records))
+                records = []
+
+        if records or not chunks:
+            chunks.append(_preprocess_streaming_chunk(records))
+    finally:
+        workbook.close()
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    # 合并各块记录的预处理警告（内容不同的attrs在concat时会被丢弃）
+    parse_warnings = list(dict.fromkeys(
+        message for chunk in chunks for message in chunk.attrs.get('parse_warnings', [])
+    ))
+    df = pd.concat(chunks, ignore_index=True)
+    if parse_warnings:
+        df.attrs['parse_warnings'] = parse_warnings
+    return df
+
+
+def _preprocess_streaming_chunk(records):
+    chunk = pd.DataFrame.from_records(records, columns=REQUIRED_COLUMNS)
+
+    # 空单元格读入为None，统一转换为NaN（与pd.read_excel一致），数值列转换为数值类型
+    chunk = chunk.where(chunk.notna(), np.nan)
+    for col in ['单价（箱）', '数量（箱）']:
+        try:
+            chunk[col] = pd.to_numeric(chunk[col])
+        except (ValueError, TypeError):
+            pass
+
+    return preprocess_sales_data(chunk)
+
+
+# 计算源文件指纹（路径、大小、修改时间）
+def source_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'version': COLUMNAR_CACHE_VERSION
+    }
+
+
+# 计算文件内容的SHA-256
+def file_sha256(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# 列式缓存文件路径（按源文件绝对路径区分）
+def _columnar_cache_paths(fingerprint):
+    key = hashlib.sha1(fingerprint['path'].encode('utf-8')).hexdigest()
+    base = os.path.join(COLUMNAR_CACHE_DIR, key)
+    return base + '.parquet', base + '.json'
+
+
+# 读取列式缓存
+def read_columnar_cache(fingerprint):
+    """
+    读取与源文件对应的Parquet缓存。路径、大小、修改时间一致时直接命中；
+    仅修改时间变化时比较内容哈希，内容未变则继续使用缓存。未命中返回None
+    """
+    data_path, meta_path = _columnar_cache_paths(fingerprint)
+    if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+        return None
+
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        if meta.get('version') != fingerprint['version'] or meta.get('size') != fingerprint['size']:
+            return None
+
+        if meta.get('mtime_ns') != fingerprint['mtime_ns']:
+            # 修改时间变化但内容可能未变，比较内容哈希
+            fingerprint['sha256'] = file_sha256(fingerprint['path'])
+            if meta.get('sha256') != fingerprint['sha256']:
+                return None
+            meta['mtime_ns'] = fingerprint['mtime_ns']
+            write_json_atomic(meta_path, meta)
+
+        return pd.read_parquet(data_path)
+    except Exception as e:
+        print(f"读取列式缓存时出错: {e}，文件: {fingerprint['path']}")
+        return None
+
+
+# 写入列式缓存
+def write_columnar_cache(fingerprint, df):
+    """
+    将预处理后的数据保存为Parquet文件，并记录源文件的路径、大小、修改时间和内容哈希
+    """
+    data_path, meta_path = _columnar_cache_paths(fingerprint)
+    try:
+        os.makedirs(COLUMNAR_CACHE_DIR, exist_ok=True)
+        meta = dict(fingerprint)
+        if 'sha256' not in meta:
+            meta['sha256'] = file_sha256(fingerprint['path'])
+
+        tmp_path = data_path + '.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, data_path)
+        write_json_atomic(meta_path, meta)
+    except Exception as e:
+        # 缓存写入失败不影响数据加载（例如未安装pyarrow）
+        print(f"写入列式缓存时出错: {e}，文件: {fingerprint['path']}")
+
+
+def write_json_atomic(path, payload):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# 规范化列名：统一全角/半角字符并去除空白
+def _normalize_column_name(name):
+    if name is None:
+        return ''
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', str(name)))
+
+
+# 读取工作簿中每个工作表的表头行
+def _read_sheet_headers(source, is_xlsx):
+    if is_xlsx:
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            return [
+                (worksheet.title, next(worksheet.iter_rows(min_row=1, max_row=1, values_only=True), ()))
+                for worksheet in workbook.worksheets
+            ]
+        finally:
+            workbook.close()
+
+    # xls等其他格式通过pandas只读取表头
+    with pd.ExcelFile(source) as excel_file:
+        return [
+            (sheet, tuple(pd.read_excel(excel_file, sheet_name=sheet, nrows=0).columns))
+            for sheet in excel_file.sheet_names
+        ]
+
+
+# 表头预检
+def validate_workbook_headers(source, is_xlsx=True):
+    """
+    只读取每个工作表的表头行，按规范化列名和COLUMN_ALIASES匹配必需列，选择第一个包含全部必需列的工作表。
+    标准列名优先：先取表头中原样存在的标准列，再按规范化后的标准列名匹配，最后才用别名补齐仍缺少的列，
+    因此"单价"和"单价（箱）"同时存在时使用后者，也不会重命名为表头中已有的列名。
+    返回(工作表名称, {原列名: 标准列名})；没有合适的工作表时抛出ValueError，列出每个工作表缺少的列
+    """
+    canonical_lookup = {_normalize_column_name(col): col for col in REQUIRED_COLUMNS}
+    alias_lookup = {_normalize_column_name(alias): col for alias, col in COLUMN_ALIASES.items()}
+
+    reports = []
+    for sheet_name, header in _read_sheet_headers(source, is_xlsx):
+        column_mapping = {}
+        found = {col for col in REQUIRED_COLUMNS if col in header}
+        for lookup in (canonical_lookup, alias_lookup):
+            for name in header:
+                canonical = lookup.get(_normalize_column_name(name))
+                if canonical is None or canonical in found or name in found or name in column_mapping:
+                    continue
+                found.add(canonical)
+                column_mapping[name] = canonical
+
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in found]
+        if not missing_columns:
+            return sheet_name, column_mapping
+        reports.append(f"工作表「{sheet_name}」缺少 {', '.join(missing_columns)}")
+
+    raise ValueError(f"文件缺少必要的列: {'；'.join(reports) if reports else '工作簿中没有工作表'}")
+
+
+# 解析单个工作簿
+def parse_sales_workbook(source):
+    """
+    读取并预处理单个工作簿，不调用界面函数，可以在子进程中运行。
+    source为文件路径时优先使用列式缓存，也可以是工作簿的字节内容；缺少必需列时抛出ValueError。
+    预处理警告保存在返回数据的attrs['parse_warnings']中
+    """
+    fingerprint = None
+    if isinstance(source, (bytes, bytearray)):
+        size = len(source)
+        is_xlsx = bytes(source[:2]) == b'PK'  # xlsx是zip格式
+        reader_source = BytesIO(source)
+    else:
+        # 优先读取列式缓存
+        fingerprint = source_fingerprint(source)
+        cached_df = read_columnar_cache(fingerprint)
+        if cached_df is not None:
+            return cached_df
+        size = fingerprint['size']
+        is_xlsx = str(source).lower().endswith('.xlsx')
+        reader_source = source
+
+    # 解析前只读取表头：选择工作表、匹配列名，不合格的文件立即拒绝
+    sheet_name, column_mapping = validate_workbook_headers(reader_source, is_xlsx)
+    if hasattr(reader_source, 'seek'):
+        reader_source.seek(0)
+
+    if is_xlsx and size >= STREAMING_THRESHOLD_BYTES:
+        # 大型工作簿使用流式解析，边读取边预处理
+        df = read_excel_streaming(reader_source, sheet_name=sheet_name, column_mapping=column_mapping)
+    else:
+        df = pd.read_excel(reader_source, sheet_name=sheet_name)
+        df = df.rename(columns=column_mapping)
+
+        # 确保所有必要的列都存在
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing_columns:
+            raise ValueError(f"文件缺少必要的列: {', '.join(missing_columns)}")
+
+        df = preprocess_sales_data(df)
+
+    # 保存列式缓存，供后续加载使用
+    if fingerprint is not None:
+        write_columnar_cache(fingerprint, df)
+
+    return df
+
+
+# 创建产品代码到简化产品名称的映射函数 - 修复版本
+def get_simplified_product_name(product_code, product_name):
+    """
+    从产品名称中提取简化产品名称，增强错误处理
+    """
+    try:
+        # 确保输入是字符串类型
+        if not isinstance(product_name, str):
+            return str(product_code)  # 返回产品代码作为备选
+
+        if '口力' in product_name:
+            # 提取"口力"之后的产品类型
+            name_parts = product_name.split('口力')
+            if len(name_parts) > 1:
+                name_part = name_parts[1]
+                if '-' in name_part:
+                    name_part = name_part.split('-')[0].strip()
+
+                # 进一步简化，只保留主要部分（去掉规格和包装形式）
+                for suffix in ['G分享装袋装', 'G盒装', 'G袋装', 'KG迷你包', 'KG随手包']:
+                    if suffix in name_part:
+                        name_part = name_part.split(suffix)[0]
+                        break
+
+                # 去掉可能的数字和单位
+                simple_name = re.sub(r'\d+\w*\s*', '', name_part).strip()
+
+                if simple_name:  # 确保简化名称不为空
+                    return f"{simple_name} ({product_code})"
+
+        # 如果无法提取或处理中出现错误，则返回产品代码
+        return str(product_code)
+    except Exception as e:
+        # 捕获任何异常，确保函数始终返回一个字符串
+        print(f"简化产品名称时出错: {e}，产品代码: {product_code}")
+        return str(product_code)
+
+
+# 批量生成简化产品名称 - 每个唯一产品只计算一次
+def simplify_product_names(df):
+    """
+    按唯一的(产品代码, 产品名称)组合调用get_simplified_product_name，再按组号映射回每一行，
+    结果与逐行计算完全一致
+    """
+    keys = df[['产品代码', '产品名称']]
+
+    # 组号按首次出现的顺序编号，与drop_duplicates保留的顺序一致
+    group_ids = keys.groupby(['产品代码', '产品名称'], sort=False, dropna=False).ngroup().to_numpy()
+    unique_keys = keys.drop_duplicates()
+
+    simplified = np.array(
+        [get_simplified_product_name(code, name)
+         for code, name in zip(unique_keys['产品代码'], unique_keys['产品名称'])],
+        dtype=object
+    )
+
+    return pd.Series(simplified[group_ids], index=df.index, dtype=object)
+
+
+# 包装类型的全部类别（固定的类别列表，保证不同数据集的分类编码一致）
+PACKAGING_TYPES = ['分享装袋装', '分享装盒装', '随手包', '迷你包', '分享装', '袋装', '盒装',
+                   '大包装', '中包装', '小包装', '散装', '其他']
+
+
+# 提取包装类型 - 向量化版本
+def classify_packaging(product_names):
+    """
+    根据产品名称批量提取包装类型。每个唯一产品名称只判断一次，规则顺序：
+    组合类型 → 包装大小 → 包装形式 → KG规格 → 按克重分档（≤50G小包装，≤100G中包装，其余大包装），
+    无法识别的归为"其他"。返回分类（category）类型的Series
+    """
+    row_codes, unique_names = pd.factorize(product_names)
+    names = pd.Series(unique_names, dtype=object)
+
+    is_str = names.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    text = names.where(is_str, '')
+
+    def contains(pattern):
+        return text.str.contains(pattern, regex=False).to_numpy(dtype=bool)
+
+    has_kg = contains('KG') | contains('kg')
+    is_large_kg = contains('1.5KG') | contains('1.5kg') | contains('2KG') | contains('2kg')
+    has_g = contains('G')
+    weight = text.str.extract(r'(\d+)G', expand=False).map(int, na_action='ignore').to_numpy(dtype=float)
+    has_weight = has_g & ~np.isnan(weight)
+
+    conditions = [
+        ~is_str,
+        contains('分享装袋装'),
+        contains('分享装盒装'),
+        contains('随手包'),
+        contains('迷你包'),
+        contains('分享装'),
+        contains('袋装'),
+        contains('盒装'),
+        has_kg & is_large_kg,
+        has_kg,
+        has_weight & (weight <= 50),
+        has_weight & (weight <= 100),
+        has_weight
+    ]
+    choices = ['其他', '分享装袋装', '分享装盒装', '随手包', '迷你包', '分享装', '袋装', '盒装',
+               '大包装', '散装', '小包装', '中包装', '大包装']
+    unique_labels = np.select(conditions, choices, default='其他')
+
+    # 映射回每一行（缺失的产品名称归为"其他"）
+    unique_codes = pd.Categorical(unique_labels, categories=PACKAGING_TYPES).codes
+    other_code = PACKAGING_TYPES.index('其他')
+    codes = np.where(row_codes >= 0, unique_codes[row_codes] if len(unique_codes) else other_code, other_code)
+
+    index = product_names.index if isinstance(product_names, pd.Series) else None
+    return pd.Series(pd.Categorical.from_codes(codes, categories=PACKAGING_TYPES), index=index)
+
+
+# 子进程中解析单个工作簿的任务
+def _parse_workbook_task(task):
+    label, source = task
+    try:
+        df = parse_sales_workbook(source)
+        df['来源文件'] = label
+        return label, df, None
+    except Exception as e:
+        return label, None, str(e)
+
+
+# 并行解析多个工作簿
+def parse_workbooks_parallel(tasks):
+    """
+    使用进程池并发解析多个工作簿，返回(文件名, 数据, 错误信息)列表，顺序与输入一致。
+    进程池不可用时退回顺序解析
+    """
+    max_workers = min(len(tasks), os.cpu_count() or 1)
+    if max_workers <= 1:
+        return [_parse_workbook_task(task) for task in tasks]
+
+    try:
+        # 使用spawn启动子进程：Streamlit服务进程是多线程的，fork可能复制其他线程持有的锁导致子进程死锁。
+        # 子进程只导入本模块，不会重新执行仪表盘脚本
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            return list(executor.map(_parse_workbook_task, tasks))
+    except (OSError, BrokenProcessPool, pickle.PicklingError) as e:
+        print(f"进程池解析失败: {e}，改为顺序解析")
+        return [_parse_workbook_task(task) for task in tasks]